@@ -2,7 +2,44 @@ from aliyunsdkcore.client import AcsClient
 from aliyunsdkcore.request import CommonRequest
 from aliyunsdkcore.acs_exception.exceptions import ClientException
 from aliyunsdkcore.acs_exception.exceptions import ServerException
-import logging, configparser, json
+from concurrent.futures import ThreadPoolExecutor
+from apicache import ApiCache
+import logging, configparser, json, threading
+import time, random, os, hashlib, calendar, fcntl
+
+
+class TokenBucket():
+    """令牌桶限速，取不到令牌时等待
+
+    argvs:
+        rate: 每秒产生的令牌数
+        capacity: 桶的容量，也就是允许的突发请求数
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，令牌不够时预支并等待到令牌产生
+
+        return:
+            wait_time = 0.5 //等待的秒数
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            self.tokens -= 1
+            wait_time = max(0.0, -self.tokens / self.rate)
+
+        if wait_time:
+            time.sleep(wait_time)
+        return wait_time
 
 
 class AliYun():
@@ -10,9 +47,12 @@ class AliYun():
 
     argvs:
         CONF_SITE: 配置文件所在的位置
+        section: 账号所在的配置段，默认为[aliyun]
+        region_id: 地域，默认为配置段中的region_id
+        rate_share: 分到的限速比例，同一个账号多个进程同时查询时按进程数平分
     """
 
-    def __init__(self,CONF_SITE):
+    def __init__(self,CONF_SITE, section='aliyun', region_id=None, rate_share=1.0):
         #日志
         logging.basicConfig(level=logging.INFO,
             format='%(asctime)s %(funcName)s %(levelname)s %(message)s',
@@ -23,17 +63,333 @@ class AliYun():
         self.cfg = configparser.ConfigParser()
         self.cfg.read(CONF_SITE)
 
-        #[ak、sk、所在地域、初始化]
-        aliyun_user_ak = self.cfg['aliyun']['aliyun_user_ak']
-        aliyun_user_sk = self.cfg['aliyun']['aliyun_user_sk']
-        region_id = self.cfg['aliyun']['region_id']
-        self.client = AcsClient(ak=aliyun_user_ak, secret=aliyun_user_sk, region_id=region_id, timeout=300)
+        #[ak、sk、所在地域、初始化，账号相关的配置从section中读取]
+        self.section = section
+        aliyun_user_ak = self.cfg[section]['aliyun_user_ak']
+        aliyun_user_sk = self.cfg[section]['aliyun_user_sk']
+        region_id = region_id or self.cfg.get(section, 'region_id', fallback=self.cfg['aliyun']['region_id'])
+        self.region_id = region_id
+        #sdk自带的重试不经过令牌桶也不计入重试统计，关掉后统一由call_action退避重试
+        self.client = AcsClient(ak=aliyun_user_ak, secret=aliyun_user_sk, region_id=region_id, timeout=300, auto_retry=False)
+        self.account = [aliyun_user_ak, region_id]
+
+        #[waf实例，高防所在的地域]
+        self.waf_id = self.cfg.get(section, 'waf_id', fallback='')
+        self.ddos_region = self.cfg.get(section, 'ddos_region', fallback='cn-hangzhou')
 
         #阿里云中VPC的信息
         self.vpc_info_dict = {}
 
+        #列表接口中资源的修改时间，资源在缓存之后修改过时，详情接口不使用缓存
+        self.change_time_dict = {}
+
+        #内网ip对应的ECS信息，ECS的id对应的内网ip，执行load_ecs_info后才会有值
+        self.ecs_info_index = None
+        self.ecs_id_index = None
+
+        #分页查询时是否预取下一页，每页的数量，0为按每个接口允许的最大值，超过接口上限时按上限
+        self.page_prefetch = self.cfg.getboolean('aliyun', 'page_prefetch', fallback=False)
+        self.page_size = self.cfg.getint('aliyun', 'page_size', fallback=0)
+        self.page_executor = ThreadPoolExecutor(max_workers=4)
+
+        #并发查询详情的线程池，每个产品的并发上限在[aliyun_concurrency]中配置，默认和线程池一致
+        self.max_workers = self.cfg.getint('aliyun', 'max_workers', fallback=8)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.semaphore_dict = {}
+        self.semaphore_lock = threading.Lock()
+
+        #每个产品的限速在[aliyun_rate]中配置，单位为每秒请求数
+        self.default_rate = self.cfg.getfloat('aliyun', 'rate_limit', fallback=10)
+        self.rate_share = rate_share
+        self.max_retry = self.cfg.getint('aliyun', 'max_retry', fallback=5)
+        self.retry_delay = self.cfg.getfloat('aliyun', 'retry_delay', fallback=1)
+        self.bucket_dict = {}
+        self.api_stat_dict = {}
+        self.api_stat_lock = threading.Lock()
+
+        #接口返回内容的本地缓存，[api_cache]中没有配置cache_file时不使用
+        if self.cfg.get('api_cache', 'cache_file', fallback=''):
+            self.api_cache = ApiCache(CONF_SITE)
+        else:
+            self.api_cache = None
+
+        #waf防护模块状态的查询线程池，和self.executor分开，避免在self.executor的任务中提交任务互相等待
+        #域名配置没有变化并且没有超过waf_cache_ttl秒时，直接用waf_cache_file中上次查到的防护状态
+        self.waf_executor = ThreadPoolExecutor(max_workers=self.cfg.getint('aliyun', 'waf_workers', fallback=8))
+        self.waf_cache_file = self.cfg.get('aliyun', 'waf_cache_file', fallback='/usr/local/cmdb/waf_status.json')
+        self.waf_cache_ttl = self.cfg.getfloat('aliyun', 'waf_cache_ttl', fallback=3600)
+        self.waf_cache_dict = None
+        self.waf_ssl_dict = {}
+        self.waf_cache_lock = threading.Lock()
+
+    def get_bucket(self, product):
+        """获取产品对应的令牌桶
+
+        argvs:
+            product = "slb"
+
+        return:
+            bucket: TokenBucket
+        """
+
+        with self.api_stat_lock:
+            if product not in self.bucket_dict:
+                rate = self.cfg.getfloat('aliyun_rate', product, fallback=self.default_rate) * self.rate_share
+
+                #限速配置为0或负数时令牌永远不够，还会除以0，按默认的每秒10个处理
+                if rate <= 0:
+                    self.logging.warning(product + "的限速配置无效:" + str(rate) + "，按每秒10个请求限速")
+                    rate = 10 * self.rate_share
+                self.bucket_dict[product] = TokenBucket(rate, max(1, rate))
+                self.api_stat_dict[product] = {"call": 0, "retry": 0, "wait_time": 0.0}
+            return self.bucket_dict[product]
+
+    def add_api_stat(self, product, field, value):
+        """累加接口调用的统计
+
+        argvs:
+            product = "slb"
+            field = "retry" //call调用次数，retry重试次数，wait_time限速和退避等待的秒数
+            value = 1
+        """
+
+        with self.api_stat_lock:
+            self.api_stat_dict[product][field] += value
+
+    def is_retry_error(self, e):
+        """判断异常是否是限流或临时性的错误，这类错误可以重试
+
+        argvs:
+            e: ServerException或ClientException
+
+        return:
+            True
+        """
+
+        error_code = e.get_error_code() or ""
+        if isinstance(e, ServerException):
+            if error_code.startswith("Throttling") or error_code in ("ServiceUnavailable", "InternalError"):
+                return True
+            return e.get_http_status() is not None and e.get_http_status() >= 500
+        return error_code in ("SDK.HttpError", "SDK.ServerUnreachable", "SDK.TimeoutError")
+
+    def do_action(self, product, request, change_time=None):
+        """调用接口，[api_cache_ttl]中配置了缓存时间的接口先从本地缓存中取
+
+        argvs:
+            product = "slb" //产品名称，用于限速、统计和缓存时间
+            request: 阿里云sdk的request
+            change_time = 1622376664.0 //资源的修改时间，早于这个时间的缓存不使用
+
+        return:
+            response: 接口返回的内容
+        """
+
+        if self.api_cache is None:
+            return self.call_action(product, request)
+
+        #普通接口按action区分，edas这类按路径区分
+        action = request.get_action_name() or request.get_uri_pattern()
+        ttl = self.api_cache.get_ttl(product, action)
+        if not ttl:
+            return self.call_action(product, request)
+
+        #key要在调用前生成，sdk签名时会往请求参数中写入时间戳等字段
+        key = self.api_cache.make_key(product, action, request, self.account)
+        response = self.api_cache.get(product, key, ttl, change_time)
+        if response is None:
+            response = self.call_action(product, request)
+            self.api_cache.put(product, key, response)
+        return response
+
+    def call_action(self, product, request):
+        """限速后调用接口，遇到限流和临时性错误时按指数退避加随机抖动重试
+
+        argvs:
+            product = "slb" //产品名称，用于限速和统计
+            request: 阿里云sdk的request
+
+        return:
+            response: 接口返回的内容
+        """
+
+        bucket = self.get_bucket(product)
+        retry = 0
+        while True:
+            self.add_api_stat(product, "wait_time", bucket.acquire())
+            self.add_api_stat(product, "call", 1)
+            try:
+                return self.client.do_action_with_exception(request)
+            except (ServerException, ClientException) as e:
+                if retry >= self.max_retry or not self.is_retry_error(e):
+                    raise
+                delay = random.uniform(0, self.retry_delay * 2 ** retry)
+                retry += 1
+                self.logging.warning(product + "接口" + str(e.get_error_code()) + "，" + str(round(delay, 2)) + "秒后第" + str(retry) + "次重试")
+                self.add_api_stat(product, "retry", 1)
+                self.add_api_stat(product, "wait_time", delay)
+                time.sleep(delay)
+
+    def get_semaphore(self, product):
+        """获取产品对应的并发控制
+
+        argvs:
+            product = "slb"
+
+        return:
+            semaphore: threading.BoundedSemaphore
+        """
+
+        with self.semaphore_lock:
+            if product not in self.semaphore_dict:
+                limit = self.cfg.getint('aliyun_concurrency', product, fallback=self.max_workers)
+                self.semaphore_dict[product] = threading.BoundedSemaphore(limit)
+            return self.semaphore_dict[product]
+
+    def run_batch(self, product, func, argv_list):
+        """在线程池中并发执行同一个产品的查询，结果按传入的顺序返回
+
+        argvs:
+            product = "slb" //产品名称，用于并发限制
+            func = self.get_slb_recording //查询方法
+            argv_list = ["lb-xxxxxxxxxxxxx", ("lb-xxxxxxxxxxxxx", "80")] //每次调用的参数，多个参数用元组
+
+        return:
+            result_list = [{}, {}] //和argv_list一一对应
+        """
+
+        semaphore = self.get_semaphore(product)
+
+        def run(argv):
+            if not isinstance(argv, tuple):
+                argv = (argv,)
+            with semaphore:
+                return func(*argv)
+
+        future_list = [self.executor.submit(run, argv) for argv in argv_list]
+        return [future.result() for future in future_list]
+
+    def log_api_stat(self):
+        """输出每个产品的接口调用次数、重试次数和等待时间"""
+
+        with self.api_stat_lock:
+            for product, stat_dict in sorted(self.api_stat_dict.items()):
+                self.logging.info(product + "接口调用" + str(stat_dict["call"]) + "次，重试" + str(stat_dict["retry"]) + "次，等待" + str(round(stat_dict["wait_time"], 2)) + "秒")
+
+        if self.api_cache is not None:
+            self.api_cache.log_stat()
+
+    def get_change_time(self, info_dict, key_list):
+        """取出资源的创建或修改时间，转换成时间戳，有多个字段时取最晚的
+
+        argvs:
+            info_dict = {"CreateTime": "2021-05-30T12:11:04Z"}
+            key_list = ["UpdateTime", "CreateTime"] //时间字段，可以是毫秒时间戳或者UTC时间字符串
+
+        return:
+            change_time = 1622376664.0 //没有时间字段时返回None
+        """
+
+        time_list = []
+        for key in key_list:
+            value = info_dict.get(key)
+            if isinstance(value, (int, float)) or (isinstance(value, str) and value.isdigit()):
+                time_list.append(float(value) / 1000)
+            elif isinstance(value, str):
+                for time_format in ("%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%MZ", "%Y-%m-%d %H:%M:%S"):
+                    try:
+                        time_list.append(float(calendar.timegm(time.strptime(value, time_format))))
+                        break
+                    except ValueError:
+                        pass
+
+        if time_list:
+            return max(time_list)
+        return None
+
+    def is_changed(self, info_dict, key_list, since):
+        """判断资源在since之后是否有创建或修改，since为None或者没有时间字段时都当作有变化
+
+        argvs:
+            info_dict = {"CreateTime": "2021-05-30T12:11:04Z"}
+            key_list = ["CreateTime"]
+            since = 1622376000 //上次同步的时间戳
+
+        return:
+            True
+        """
+
+        if since is None:
+            return True
+        change_time = self.get_change_time(info_dict, key_list)
+        return change_time is None or change_time >= since
+
+    def get_page(self, product, request, page_number, page_size):
+        """查询分页接口中的某一页
+
+        argvs:
+            product = "slb"
+            request: 阿里云sdk的request
+            page_number = 1
+            page_size = 100
+
+        return:
+            res_dict = {"TotalCount": 1}
+        """
+
+        request.add_query_param('PageNumber', page_number)
+        request.add_query_param('PageSize', page_size)
+        response = self.do_action(product, request)
+        return json.loads(response)
+
+    def iter_page(self, product, request, item_path, max_page_size, total_key="TotalCount"):
+        """逐页查询接口，逐条返回所有页中的数据，开启page_prefetch时处理当前页的同时预取下一页
+
+        argvs:
+            product = "slb"
+            request: 阿里云sdk的request
+            item_path = ["LoadBalancers", "LoadBalancer"] //返回数据中列表所在的路径
+            max_page_size = 100 //接口允许的每页最大数量，配置的page_size超过时按这个值
+            total_key = "TotalCount" //返回数据中总数的字段
+
+        return:
+            item: 列表中的每一条数据
+        """
+
+        if self.page_size > 0:
+            page_size = min(self.page_size, max_page_size)
+        else:
+            page_size = max_page_size
+
+        page_number = 1
+        res_dict = self.get_page(product, request, page_number, page_size)
+        while True:
+            item_list = res_dict
+            for key in item_path:
+                item_list = item_list[key]
+
+            #不满一页或者已经到总数，说明是最后一页
+            last_page = len(item_list) < page_size
+            if total_key in res_dict and page_number * page_size >= int(res_dict[total_key]):
+                last_page = True
+
+            future = None
+            if not last_page and self.page_prefetch:
+                future = self.page_executor.submit(self.get_page, product, request, page_number + 1, page_size)
+
+            for item in item_list:
+                yield item
+
+            if last_page:
+                break
+            page_number += 1
+            if future:
+                res_dict = future.result()
+            else:
+                res_dict = self.get_page(product, request, page_number, page_size)
+
     def get_ecs_info(self, host_ip):
-        """查询ECS信息
+        """查询ECS信息，如果已经执行过load_ecs_info，则直接从内存索引中获取
 
         argvs:
             host_ip = "1.1.1.1"
@@ -49,17 +405,34 @@ class AliYun():
             }
         """
 
+        #已经批量加载过，就不再调用接口
+        if self.ecs_info_index is not None:
+            return self.make_ecs_info(self.ecs_info_index.get(host_ip))
+
         from aliyunsdkecs.request.v20140526.DescribeInstancesRequest import DescribeInstancesRequest
         request = DescribeInstancesRequest()
         request.set_accept_format('json')
         request.set_InstanceNetworkType("vpc")
         request.set_PrivateIpAddresses([host_ip])
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("ecs", request)
         res_dict = json.loads(response)
 
-        ecs_info_dict = {}
         if res_dict["Instances"]["Instance"]:
-            ecs_info = res_dict["Instances"]["Instance"][0]
+            return self.make_ecs_info(res_dict["Instances"]["Instance"][0])
+        return self.make_ecs_info(None)
+
+    def make_ecs_info(self, ecs_info):
+        """把接口返回的ECS信息转换为cmdb使用的字典，为None时按物理机处理
+
+        argvs:
+            ecs_info = {"InstanceId": "i-2zexxxxxxxxx"}
+
+        return:
+            ecs_info_dict = {"bk_type": "0"}
+        """
+
+        ecs_info_dict = {}
+        if ecs_info:
             ecs_info_dict["bk_create_time"] = ecs_info["CreationTime"]
             ecs_info_dict["bk_ecs_name"] = ecs_info["InstanceName"]
             if ecs_info['EipAddress']['IpAddress']:
@@ -67,7 +440,7 @@ class AliYun():
             else:
                 ecs_info_dict["bk_bandwidth"] = "0"
             ecs_info_dict["bk_aliyun_id"] = ecs_info["InstanceId"]
-            ecs_info_dict["bk_vpc"] = self.vpc_info_dict[ecs_info["VpcAttributes"]["VpcId"]]
+            ecs_info_dict["bk_vpc"] = self.vpc_info_dict.get(ecs_info["VpcAttributes"]["VpcId"], "None")
             ecs_info_dict["bk_type"] = "0"
 
         else:
@@ -79,7 +452,49 @@ class AliYun():
             ecs_info_dict["bk_type"] = "1"
 
         return ecs_info_dict
-        
+
+    def load_ecs_info(self):
+        """一次性分页拉取当前地域所有VPC类型的ECS，建立以内网ip为key的索引，
+        之后get_ecs_info直接从索引中取值，同时建立ECS的id到内网ip的索引
+
+        return:
+            ecs_info_index = {"1.1.1.1": {"InstanceId": "i-2zexxxxxxxxx"}}
+        """
+
+        from aliyunsdkecs.request.v20140526.DescribeInstancesRequest import DescribeInstancesRequest
+
+        request = DescribeInstancesRequest()
+        request.set_accept_format('json')
+        request.set_InstanceNetworkType("vpc")
+
+        ecs_info_index = {}
+        ecs_id_index = {}
+        for ecs_info in self.iter_page("ecs", request, ["Instances", "Instance"], 100):
+            ip_list = ecs_info["VpcAttributes"]["PrivateIpAddress"]["IpAddress"]
+            for host_ip in ip_list:
+                ecs_info_index[host_ip] = ecs_info
+            if ip_list:
+                ecs_id_index[ecs_info["InstanceId"]] = ip_list[0]
+
+        self.ecs_info_index = ecs_info_index
+        self.ecs_id_index = ecs_id_index
+        self.logging.info("加载ECS信息" + str(len(ecs_info_index)) + "条")
+        return ecs_info_index
+
+    def get_ecs_ip(self, ecs_id):
+        """根据ECS的id获取内网ip，没有加载过ECS索引时先加载，找不到时返回原来的id
+
+        argvs:
+            ecs_id = "i-2zexxxxxxxxx"
+
+        return:
+            host_ip = "1.1.1.1"
+        """
+
+        if self.ecs_id_index is None:
+            self.load_ecs_info()
+        return self.ecs_id_index.get(ecs_id, ecs_id)
+
     def get_vpc(self):
         """获取VPC信息
 
@@ -90,13 +505,10 @@ class AliYun():
         from aliyunsdkvpc.request.v20160428.DescribeVpcsRequest import DescribeVpcsRequest
         request = DescribeVpcsRequest()
         request.set_accept_format('json')
-        response = self.client.do_action_with_exception(request)
-        res_dict = json.loads(response)
 
         vpc_info_dict = {}
-        if res_dict["TotalCount"] != 0:
-            for vpc_info in res_dict["Vpcs"]["Vpc"]:
-                vpc_info_dict[vpc_info["VpcId"]] = vpc_info["VpcName"]
+        for vpc_info in self.iter_page("vpc", request, ["Vpcs", "Vpc"], 50):
+            vpc_info_dict[vpc_info["VpcId"]] = vpc_info["VpcName"]
 
         return vpc_info_dict
 
@@ -110,15 +522,10 @@ class AliYun():
 
         request = DescribeDomainsRequest()
         request.set_accept_format('json')
-        request.set_PageSize("99")
-        response = self.client.do_action_with_exception(request)
-        res_dict = json.loads(response)
-        
-        #查看总是是不是大于0
+
         dns_name_list = []
-        if res_dict["TotalCount"] > 0:
-            for i in res_dict["Domains"]["Domain"]:
-                dns_name_list.append(i["DomainName"])
+        for i in self.iter_page("alidns", request, ["Domains", "Domain"], 100):
+            dns_name_list.append(i["DomainName"])
         return dns_name_list
 
     def get_dns_recording(self, dns_name):
@@ -141,18 +548,18 @@ class AliYun():
 
         request = DescribeDomainRecordsRequest()
         request.set_accept_format('json')
-        request.set_PageSize("499")
         request.set_DomainName(dns_name)
-        response = self.client.do_action_with_exception(request)
-        res_dict = json.loads(response)
+        dns_recording_list = list(self.iter_page("alidns", request, ["DomainRecords", "Record"], 500))
 
-        #查看总数是不是大于0，有的域名没有记录
-        if res_dict["TotalCount"] > 0:
-            dns_recording_list = res_dict["DomainRecords"]["Record"]
+        #有的域名没有记录
+        if dns_recording_list:
             return dns_recording_list
 
-    def get_slb_id(self):
-        """获取当前账号下SLB的id号列表
+    def get_slb_id(self, since=None):
+        """获取当前账号下SLB的id号列表，传入since时只返回之后创建的
+
+        argvs:
+            since = 1622376000 //上次同步的时间戳
 
         return:
             slb_id_list = ['lb-xxxxxxxxxxxxxxxx', 'lb-ccccccccccccc']
@@ -161,13 +568,12 @@ class AliYun():
 
         request = DescribeLoadBalancersRequest()
         request.set_accept_format('json')
-        request.set_PageSize(99)
-        response = self.client.do_action_with_exception(request)
 
         #拿出id号
         slb_id_list = []
-        res_dict = json.loads(response)
-        for i in res_dict["LoadBalancers"]["LoadBalancer"]:
+        for i in self.iter_page("slb", request, ["LoadBalancers", "LoadBalancer"], 100):
+            if not self.is_changed(i, ["CreateTimeStamp", "CreateTime"], since):
+                continue
             slb_id_list.append(i["LoadBalancerId"])
         return slb_id_list
 
@@ -193,7 +599,7 @@ class AliYun():
         request = DescribeLoadBalancerAttributeRequest()
         request.set_accept_format('json')
         request.set_LoadBalancerId(slb_id)
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("slb", request)
         res_dict = json.loads(response)
 
         slb_info_dict = {}
@@ -220,7 +626,7 @@ class AliYun():
             slb_info_dict["bk_spec_type"] = "0"
 
         if res_dict["VpcId"]:
-            slb_info_dict["bk_vpc"] = self.vpc_info_dict[res_dict["VpcId"]]
+            slb_info_dict["bk_vpc"] = self.vpc_info_dict.get(res_dict["VpcId"], "None")
         else:
             slb_info_dict["bk_vpc"]  = "None"
 
@@ -250,7 +656,7 @@ class AliYun():
         request.set_accept_format('json')
         request.set_ListenerPort(slb_port)
         request.set_LoadBalancerId(slb_id)
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("slb", request)
 
         res_dict = json.loads(response)
         slb_rsp_dict = {}
@@ -288,7 +694,7 @@ class AliYun():
         request.set_accept_format('json')
         request.set_ListenerPort(slb_port)
         request.set_LoadBalancerId(slb_id)
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("slb", request)
 
         #先获取默认虚拟服务器
         res_dict = json.loads(response)
@@ -324,7 +730,7 @@ class AliYun():
         request.set_accept_format('json')
         request.set_ListenerPort(slb_port)
         request.set_LoadBalancerId(slb_id)
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("slb", request)
 
         res_dict = json.loads(response)
         slb_rsp_dict = {}
@@ -334,6 +740,65 @@ class AliYun():
             slb_rsp_dict["all"] = "None"
         return slb_rsp_dict
 
+    def get_slb_listener(self, slb_id, slb_port, protocol):
+        """根据协议查看SLB监听所定义的虚拟服务器组
+
+        argvs:
+            slb_id = "lb-xxxxxxxxxxxxx"
+            slb_port = 80
+            protocol = "http"
+
+        return:
+            slb_rsp_dict = {'all': 'rsp-2zexxxxxxxxxx'} //不支持的协议返回None
+        """
+
+        if protocol == "http":
+            return self.get_slb_http(slb_id, slb_port)
+        elif protocol == "https":
+            return self.get_slb_https(slb_id, slb_port)
+        elif protocol == "tcp":
+            return self.get_slb_tcp(slb_id, slb_port)
+
+    def get_slb_topology(self, slb_port_dict):
+        """查询SLB到监听、虚拟服务器组、后端主机的关系，所有监听并发查询，
+        同一个服务器组只查询一次，后端服务器的ECS id通过ECS索引转换为内网ip
+
+        argvs:
+            slb_port_dict = {"lb-xxxxxxxxxxxxx": {"80": "http"}} //SLB监听的端口和协议
+
+        return:
+            slb_topology = {
+                "slb": {
+                    "lb-xxxxxxxxxxxxx": {
+                        "80": {"protocol": "http", "rsp_dict": {"all": "rsp-2zexxxxxxxxxx"}} //不支持的协议rsp_dict为None
+                    }
+                },
+                "rsp": {"rsp-2zexxxxxxxxxx": ["1.1.1.1", "1.1.1.2"]} //服务器组的后端主机
+            }
+        """
+
+        listener_list = []
+        for slb_id, bk_port_dict in slb_port_dict.items():
+            for port, protocol in bk_port_dict.items():
+                listener_list.append((slb_id, port, protocol))
+        rsp_info_list = self.run_batch("slb", self.get_slb_listener, listener_list)
+
+        #多个监听和转发规则会用同一个服务器组，去重后再查询
+        rsp_id_list = []
+        for rsp_info_dict in rsp_info_list:
+            for rsp_id in (rsp_info_dict or {}).values():
+                if rsp_id != "None" and rsp_id not in rsp_id_list:
+                    rsp_id_list.append(rsp_id)
+        rsp_ecs_list = self.run_batch("slb", self.get_slb_rsp, rsp_id_list)
+
+        slb_topology = {"slb": {}, "rsp": {}}
+        for (slb_id, port, protocol), rsp_info_dict in zip(listener_list, rsp_info_list):
+            slb_topology["slb"].setdefault(slb_id, {})[port] = {"protocol": protocol, "rsp_dict": rsp_info_dict}
+        for rsp_id, slb_ecs_dict in zip(rsp_id_list, rsp_ecs_list):
+            slb_topology["rsp"][rsp_id] = [self.get_ecs_ip(ecs_id) for ecs_id in slb_ecs_dict.keys()]
+
+        return slb_topology
+
     def get_slb_rsp(self, slb_rsp_id):
         """获取服务器组中所对应的后端服务器ID和端口号
         
@@ -352,7 +817,7 @@ class AliYun():
         request = DescribeVServerGroupAttributeRequest()
         request.set_accept_format('json')
         request.set_VServerGroupId(slb_rsp_id)
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("slb", request)
 
         slb_ecs_dict = {}
         res_dict = json.loads(response)
@@ -369,13 +834,13 @@ class AliYun():
 
         request = CommonRequest()
         request.set_accept_format('json')
-        request.set_domain('ddoscoo.cn-hangzhou.aliyuncs.com')
+        request.set_domain('ddoscoo.' + self.ddos_region + '.aliyuncs.com')
         request.set_method('POST')
         request.set_protocol_type('https')
         request.set_version('2020-01-01')
         request.set_action_name('DescribeDomains')
-        request.add_query_param('RegionId', "cn-hangzhou")
-        response = self.client.do_action(request)
+        request.add_query_param('RegionId', self.ddos_region)
+        response = self.do_action("ddoscoo", request)
         res_dict = json.loads(response)
         ddos_domain_list = res_dict["Domains"]
         return ddos_domain_list
@@ -400,17 +865,14 @@ class AliYun():
 
         request = CommonRequest()
         request.set_accept_format('json')
-        request.set_domain('ddoscoo.cn-hangzhou.aliyuncs.com')
+        request.set_domain('ddoscoo.' + self.ddos_region + '.aliyuncs.com')
         request.set_method('POST')
         request.set_protocol_type('https')
         request.set_version('2020-01-01')
         request.set_action_name('DescribeWebRules')
-        request.add_query_param('RegionId', "cn-hangzhou")
-        request.add_query_param('PageSize', "10")
+        request.add_query_param('RegionId', self.ddos_region)
         request.add_query_param('Domain', ddos_domain)
-        response = self.client.do_action(request)
-        res_dict = json.loads(response)
-        res_dict = res_dict["WebRules"][0]
+        res_dict = list(self.iter_page("ddoscoo", request, ["WebRules"], 10))[0]
         ddos_info_dict = {}
 
         #源地址列表
@@ -458,8 +920,8 @@ class AliYun():
 
         request = DescribeDomainNamesRequest()
         request.set_accept_format('json')
-        request.set_InstanceId(self.cfg['aliyun']['waf_id'])
-        response = self.client.do_action_with_exception(request)
+        request.set_InstanceId(self.waf_id)
+        response = self.do_action("waf", request)
         res_dict = json.loads(response)
 
         return res_dict["DomainNames"]
@@ -485,16 +947,21 @@ class AliYun():
 
         request = DescribeDomainRequest()
         request.set_accept_format('json')
-        request.set_InstanceId(self.cfg['aliyun']['waf_id'])
+        request.set_InstanceId(self.waf_id)
         request.set_Domain(waf_domain)
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("waf", request)
         res_dict = json.loads(response)
 
         waf_info_dict = {}
-        #定义的防护类型
-        protect_type_list = ['waf','dld','tamperproof','antihijack','dlp','normalized','bot_crawler','bot_intelligence', \
-        'antifraud','bot_algorithm','bot_wxbb','bot_wxbb_pkg','ac_cc','ac_blacklist','ac_highfreq',\
-        'ac_dirscan','ac_scantools','ac_collaborative','ac_custom']
+
+        #https的域名在查询防护状态的同时查询证书
+        ssl_future = None
+        if res_dict["Domain"]["HttpsPort"]:
+            ssl_future = self.waf_executor.submit(self.get_waf_ssl, waf_domain)
+
+        #防护状态，域名配置的指纹用于判断缓存是否还能用
+        domain_hash = hashlib.md5(json.dumps(res_dict["Domain"], sort_keys=True).encode('utf-8')).hexdigest()
+        waf_info_dict.update(self.get_waf_protect_dict(waf_domain, domain_hash))
 
         waf_info_dict["src_ip_list"] = res_dict["Domain"]["SourceIps"]
         waf_info_dict["bk_inst_name"] = res_dict["Domain"]["Cname"].lower()
@@ -502,20 +969,94 @@ class AliYun():
         waf_info_dict["bk_https"] = str(res_dict["Domain"]["HttpsRedirect"])
         waf_info_dict["bk_waf_slb"] = str(res_dict["Domain"]["LoadBalancing"])
 
-        if res_dict["Domain"]["HttpsPort"]:
+        if ssl_future:
             waf_info_dict["bk_is_https"] = "1"
-            waf_info_dict["bk_ssl_name"] = self.get_waf_ssl(waf_domain)
+            waf_info_dict["bk_ssl_name"] = ssl_future.result()
         else:
             waf_info_dict["bk_is_https"] = "0"
             waf_info_dict["bk_ssl_name"] = "None"
 
-        #字段
-        for protect_type in protect_type_list:
-            start_status = self.get_waf_protect(waf_domain, protect_type)
-            waf_info_dict[protect_type] = str(start_status)
-
         return waf_info_dict
 
+    def load_waf_cache(self):
+        """读取上次保存的waf防护状态，文件不存在或者损坏时为空
+
+        return:
+            waf_cache_dict = {"waf-cn-xxxxxxxx/www.xx.cn": {"hash": "9e1b...", "time": 1600000000, "status": {"waf": "1"}}}
+        """
+
+        with self.waf_cache_lock:
+            if self.waf_cache_dict is None:
+                try:
+                    with open(self.waf_cache_file) as f:
+                        self.waf_cache_dict = json.load(f)
+                except (IOError, OSError, ValueError):
+                    self.waf_cache_dict = {}
+            return self.waf_cache_dict
+
+    def save_waf_cache(self):
+        """保存waf防护状态，下次同步时使用
+
+        多个账号的子进程会同时保存同一个文件，加文件锁后先合并文件中其它进程写入的记录再替换
+        """
+
+        with self.waf_cache_lock:
+            if self.waf_cache_dict is None:
+                return
+            try:
+                with open(self.waf_cache_file + ".lock", 'w') as lock_f:
+                    fcntl.flock(lock_f, fcntl.LOCK_EX)
+                    try:
+                        with open(self.waf_cache_file) as f:
+                            waf_cache_dict = json.load(f)
+                    except (IOError, OSError, ValueError):
+                        waf_cache_dict = {}
+                    waf_cache_dict.update(self.waf_cache_dict)
+
+                    #过期的记录不再保存，已经删除的域名不会一直留在文件中
+                    now = time.time()
+                    for cache_key in [k for k, v in waf_cache_dict.items() if now - v["time"] >= self.waf_cache_ttl]:
+                        del waf_cache_dict[cache_key]
+
+                    tmp_file = self.waf_cache_file + "." + str(os.getpid()) + ".tmp"
+                    with open(tmp_file, 'w') as f:
+                        json.dump(waf_cache_dict, f)
+                    os.replace(tmp_file, self.waf_cache_file)
+            except (IOError, OSError) as e:
+                self.logging.warning("保存waf防护状态失败:" + repr(e))
+
+    def get_waf_protect_dict(self, waf_domain, domain_hash):
+        """查询域名所有防护类型的状态，缓存可用时直接返回，否则并发查询
+
+        argvs:
+            waf_domain = "www.xx.cn"
+            domain_hash = "9e1b..." //域名配置的指纹，配置变化后缓存失效
+
+        return:
+            protect_dict = {"waf": "1", "dld": "0"}
+        """
+
+        #定义的防护类型
+        protect_type_list = ['waf','dld','tamperproof','antihijack','dlp','normalized','bot_crawler','bot_intelligence', \
+        'antifraud','bot_algorithm','bot_wxbb','bot_wxbb_pkg','ac_cc','ac_blacklist','ac_highfreq',\
+        'ac_dirscan','ac_scantools','ac_collaborative','ac_custom']
+
+        #同一个域名可能在多个waf实例中，按实例和域名区分
+        cache_key = self.waf_id + "/" + waf_domain
+        cache_info = self.load_waf_cache().get(cache_key)
+        if cache_info and cache_info["hash"] == domain_hash and time.time() - cache_info["time"] < self.waf_cache_ttl \
+                and set(cache_info["status"].keys()) == set(protect_type_list):
+            return dict(cache_info["status"])
+
+        future_list = [self.waf_executor.submit(self.get_waf_protect, waf_domain, protect_type) for protect_type in protect_type_list]
+        protect_dict = {}
+        for protect_type, future in zip(protect_type_list, future_list):
+            protect_dict[protect_type] = str(future.result())
+
+        with self.waf_cache_lock:
+            self.waf_cache_dict[cache_key] = {"hash": domain_hash, "time": time.time(), "status": protect_dict}
+        return dict(protect_dict)
+
     def get_waf_protect(self, waf_domain, protect_type):
         """查看
 
@@ -533,14 +1074,14 @@ class AliYun():
         request.set_accept_format('json')
         request.set_Domain(waf_domain)
         request.set_DefenseType(protect_type)
-        request.set_InstanceId(self.cfg['aliyun']['waf_id'])
-        response = self.client.do_action_with_exception(request)
+        request.set_InstanceId(self.waf_id)
+        response = self.do_action("waf", request)
         res_dict = json.loads(response)
 
         return res_dict["ModuleStatus"]
 
     def get_waf_ssl(self, waf_domain):
-        """获取waf的证书
+        """获取waf的证书，同一次同步中每个域名只查询一次
 
         argvs:
             waf_domain: "www.xx.cn"
@@ -549,20 +1090,27 @@ class AliYun():
             ssl_name: "cert-232dd"
         """
 
+        if waf_domain in self.waf_ssl_dict:
+            return self.waf_ssl_dict[waf_domain]
+
         from aliyunsdkwaf_openapi.request.v20190910.DescribeCertificatesRequest import DescribeCertificatesRequest
 
         request = DescribeCertificatesRequest()
         request.set_accept_format('json')
-        request.set_InstanceId(self.cfg['aliyun']['waf_id'])
+        request.set_InstanceId(self.waf_id)
         request.set_Domain(waf_domain)
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("waf", request)
         res_dict = json.loads(response)
 
         #证书名称
-        return res_dict["Certificates"][0]["CertificateName"]
+        self.waf_ssl_dict[waf_domain] = res_dict["Certificates"][0]["CertificateName"]
+        return self.waf_ssl_dict[waf_domain]
 
-    def get_rds_id(self):
-        """获取账号下实例id号
+    def get_rds_id(self, since=None):
+        """获取账号下实例id号，传入since时只返回之后创建的
+
+        argvs:
+            since = 1622376000 //上次同步的时间戳
 
         return:
             rds_id_list = ["xxxx", "xxxx"]
@@ -571,12 +1119,11 @@ class AliYun():
         from aliyunsdkrds.request.v20140815.DescribeDBInstancesRequest import DescribeDBInstancesRequest
         request = DescribeDBInstancesRequest()
         request.set_accept_format('json')
-        request.set_PageSize(100)
-        response = self.client.do_action_with_exception(request)
-        res_dict = json.loads(response)
 
         rds_id_list = []
-        for rds_info in res_dict["Items"]["DBInstance"]:
+        for rds_info in self.iter_page("rds", request, ["Items", "DBInstance"], 100, "TotalRecordCount"):
+            if not self.is_changed(rds_info, ["CreateTime"], since):
+                continue
             rds_id_list.append(rds_info["DBInstanceId"])
 
         return rds_id_list
@@ -604,7 +1151,7 @@ class AliYun():
         request = DescribeDBInstanceAttributeRequest()
         request.set_accept_format('json')
         request.set_DBInstanceId(rds_id)
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("rds", request)
         res_dict = json.loads(response)
 
         rds_info_dict = {}
@@ -617,12 +1164,15 @@ class AliYun():
         rds_info_dict["bk_iops"] = str(rds_info["MaxIOPS"])
         rds_info_dict["bk_connect"] = str(rds_info["MaxConnections"])
         rds_info_dict["bk_cpu"] = str(rds_info["DBInstanceCPU"])
-        rds_info_dict["bk_vpc"] = self.vpc_info_dict[rds_info["VpcId"]]
+        rds_info_dict["bk_vpc"] = self.vpc_info_dict.get(rds_info["VpcId"], "None")
 
         return rds_info_dict
 
-    def get_drds_id(self):
-        """获取账号下PolarDB-X 1.0实例id号
+    def get_drds_id(self, since=None):
+        """获取账号下PolarDB-X 1.0实例id号，传入since时只返回之后创建的
+
+        argvs:
+            since = 1622376000 //上次同步的时间戳
 
         return:
             drds_id_list = ["xxxx", "xxxx"]
@@ -631,11 +1181,11 @@ class AliYun():
         from aliyunsdkdrds.request.v20190123.DescribeDrdsInstancesRequest import DescribeDrdsInstancesRequest
         request = DescribeDrdsInstancesRequest()
         request.set_accept_format('json')
-        response = self.client.do_action_with_exception(request)
-        res_dict = json.loads(response)
 
         drds_id_list = []
-        for drds_info in res_dict["Instances"]["Instance"]:
+        for drds_info in self.iter_page("drds", request, ["Instances", "Instance"], 100, "Total"):
+            if not self.is_changed(drds_info, ["CreateTime"], since):
+                continue
             drds_id_list.append(drds_info["DrdsInstanceId"])
 
         return drds_id_list
@@ -661,7 +1211,7 @@ class AliYun():
         request = DescribeDrdsInstanceRequest()
         request.set_accept_format('json')
         request.set_DrdsInstanceId(drds_id)
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("drds", request)
         res_dict = json.loads(response)
 
         drds_info_dict = {}
@@ -673,12 +1223,15 @@ class AliYun():
         drds_info_dict["bk_drds_name"] = res_dict["Data"]["Description"]
         for vpc_info in res_dict["Data"]["Vips"]["Vip"]:
             if "VswitchId" in vpc_info.keys():
-                drds_info_dict["bk_vpc"] = self.vpc_info_dict[vpc_info["VpcId"]]
+                drds_info_dict["bk_vpc"] = self.vpc_info_dict.get(vpc_info["VpcId"], "None")
 
         return drds_info_dict
 
-    def get_redis_id(self):
-        """查询实例id
+    def get_redis_id(self, since=None):
+        """查询实例id，传入since时只返回之后创建的
+
+        argvs:
+            since = 1622376000 //上次同步的时间戳
 
         return:
             redis_id_list = ["r-2exadax"]
@@ -687,11 +1240,11 @@ class AliYun():
         from aliyunsdkr_kvstore.request.v20150101.DescribeInstancesRequest import DescribeInstancesRequest
         request = DescribeInstancesRequest()
         request.set_accept_format('json')
-        response = self.client.do_action_with_exception(request)
-        res_dict = json.loads(response)
 
         redis_id_list = []
-        for redis_info in res_dict["Instances"]["KVStoreInstance"]:
+        for redis_info in self.iter_page("r-kvstore", request, ["Instances", "KVStoreInstance"], 50):
+            if not self.is_changed(redis_info, ["CreateTime"], since):
+                continue
             redis_id_list.append(redis_info["InstanceId"])
 
         return redis_id_list
@@ -714,7 +1267,7 @@ class AliYun():
         request = DescribeInstanceAttributeRequest()
         request.set_accept_format('json')
         request.set_InstanceId(redis_id)
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("r-kvstore", request)
         res_dict = json.loads(response)
 
         redis_info_dict = {}
@@ -727,13 +1280,16 @@ class AliYun():
         redis_info_dict["bk_version"] = redis_info["EngineVersion"]
         redis_info_dict["bk_redis_name"] = redis_info["InstanceName"]
         redis_info_dict["bk_qps"] = str(redis_info["QPS"])
-        redis_info_dict["bk_vpc"] = self.vpc_info_dict[redis_info["VpcId"]]
+        redis_info_dict["bk_vpc"] = self.vpc_info_dict.get(redis_info["VpcId"], "None")
 
         return redis_info_dict
 
-    def get_edas_id(self):
-        """edas的id号
-        
+    def get_edas_id(self, since=None):
+        """edas的id号，传入since时只返回之后创建或修改的
+
+        argvs:
+            since = 1622376000 //上次同步的时间戳
+
         return:
             edas_id_list = [
                 {
@@ -748,18 +1304,21 @@ class AliYun():
         request.set_accept_format('json')
         request.set_method('POST')
         request.set_protocol_type('https')
-        request.set_domain('edas.cn-beijing.aliyuncs.com')
+        request.set_domain('edas.' + self.region_id + '.aliyuncs.com')
         request.set_version('2017-08-01')
-        request.add_query_param('RegionId', "cn-beijing")
+        request.add_query_param('RegionId', self.region_id)
         request.add_header('Content-Type', 'application/json')
         request.set_uri_pattern('/pop/v5/app/app_list')
         body = '''{}'''
         request.set_content(body.encode('utf-8'))
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("edas", request)
         res_dict = json.loads(response)
 
         edas_id_list = []
         for edas_info in res_dict["ApplicationList"]["Application"]:
+            self.change_time_dict[("edas", edas_info["AppId"])] = self.get_change_time(edas_info, ["UpdateTime", "CreateTime"])
+            if not self.is_changed(edas_info, ["UpdateTime", "CreateTime"], since):
+                continue
             tmp_dict = {}
             tmp_dict["edas_id"] = edas_info["AppId"]
             tmp_dict["edas_name"] = edas_info["Name"]
@@ -783,15 +1342,15 @@ class AliYun():
         request.set_accept_format('json')
         request.set_method('POST')
         request.set_protocol_type('https') # https | http
-        request.set_domain('edas.cn-beijing.aliyuncs.com')
+        request.set_domain('edas.' + self.region_id + '.aliyuncs.com')
         request.set_version('2017-08-01')
-        request.add_query_param('RegionId', "cn-beijing")
+        request.add_query_param('RegionId', self.region_id)
         request.add_query_param('AppId', edas_id)
         request.add_header('Content-Type', 'application/json')
         request.set_uri_pattern('/pop/v5/resource/ecu_list')
         body = '''{}'''
         request.set_content(body.encode('utf-8'))
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("edas", request, self.change_time_dict.get(("edas", edas_id)))
         res_dict = json.loads(response)
 
         ecu_ip_list = []
@@ -818,15 +1377,15 @@ class AliYun():
         request.set_accept_format('json')
         request.set_method('GET')
         request.set_protocol_type('https')
-        request.set_domain('edas.cn-beijing.aliyuncs.com')
+        request.set_domain('edas.' + self.region_id + '.aliyuncs.com')
         request.set_version('2017-08-01')
-        request.add_query_param('RegionId', "cn-beijing")
+        request.add_query_param('RegionId', self.region_id)
         request.add_query_param('AppId', edas_id)
         request.add_header('Content-Type', 'application/json')
         request.set_uri_pattern('/pop/v5/app/container_config')
         body = '''{}'''
         request.set_content(body.encode('utf-8'))
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("edas", request, self.change_time_dict.get(("edas", edas_id)))
         res_dict = json.loads(response)
 
         tomcat_info_dict = {}
@@ -857,15 +1416,15 @@ class AliYun():
         request.set_accept_format('json')
         request.set_method('GET')
         request.set_protocol_type('https')
-        request.set_domain('edas.cn-beijing.aliyuncs.com')
+        request.set_domain('edas.' + self.region_id + '.aliyuncs.com')
         request.set_version('2017-08-01')
-        request.add_query_param('RegionId', "cn-beijing")
+        request.add_query_param('RegionId', self.region_id)
         request.add_query_param('AppId', edas_id)
         request.add_header('Content-Type', 'application/json')
         request.set_uri_pattern('/pop/v5/app/app_jvm_config')
         body = '''{}'''
         request.set_content(body.encode('utf-8'))
-        response = self.client.do_action_with_exception(request)
+        response = self.do_action("edas", request, self.change_time_dict.get(("edas", edas_id)))
         res_dict = json.loads(response)
 
         jvm_info_dict = {}
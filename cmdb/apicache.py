@@ -0,0 +1,144 @@
+import logging, configparser, json, threading
+import sqlite3, hashlib, time
+
+
+class ApiCache():
+    """阿里云接口返回内容的本地缓存，存放在sqlite中，按产品设置缓存时间
+
+    argvs:
+        CONF_SITE: 配置文件所在的位置
+    """
+
+    #签名时sdk会写入请求参数中的字段，每次请求都不一样，不参与缓存的key
+    SIGN_PARAM_SET = {"Timestamp", "SignatureNonce", "Signature", "SignatureMethod", "SignatureVersion",
+        "SignatureType", "AccessKeyId", "Format", "Version", "Action"}
+
+    def __init__(self,CONF_SITE):
+        #日志
+        logging.basicConfig(level=logging.INFO,
+            format='%(asctime)s %(funcName)s %(levelname)s %(message)s',
+            datefmt='%Y-%m-%d %A %H:%M:%S')
+        self.logging = logging
+
+        #读取配置文件
+        self.cfg = configparser.ConfigParser()
+        self.cfg.read(CONF_SITE)
+
+        #[缓存文件，默认缓存时间，每个产品或接口的缓存时间在[api_cache_ttl]中配置，0为不缓存]
+        self.cache_file = self.cfg.get('api_cache', 'cache_file', fallback='/usr/local/cmdb/api_cache.db')
+        self.default_ttl = self.cfg.getfloat('api_cache', 'default_ttl', fallback=0)
+
+        #多个线程共用一个连接，读写都加锁，多个进程同时写入时等待对方释放锁
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.cache_file, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS api_cache (key TEXT PRIMARY KEY, product TEXT, response BLOB, time REAL)")
+
+        #超过最长缓存时间的记录清理掉
+        self.conn.execute("DELETE FROM api_cache WHERE time < ?", (time.time() - self.get_max_ttl(),))
+        self.conn.commit()
+
+        self.stat_dict = {}
+
+    def get_max_ttl(self):
+        """所有配置中最长的缓存时间
+
+        return:
+            max_ttl = 3600
+        """
+
+        ttl_list = [self.default_ttl]
+        if self.cfg.has_section('api_cache_ttl'):
+            ttl_list.extend(float(v) for v in self.cfg['api_cache_ttl'].values())
+        return max(ttl_list)
+
+    def get_ttl(self, product, action):
+        """查询接口的缓存时间，先找产品.接口，再找产品，都没有用默认值
+
+        argvs:
+            product = "slb"
+            action = "DescribeLoadBalancerAttribute"
+
+        return:
+            ttl = 600 //秒，0为不缓存
+        """
+
+        ttl = self.cfg.getfloat('api_cache_ttl', product + "." + str(action), fallback=None)
+        if ttl is None:
+            ttl = self.cfg.getfloat('api_cache_ttl', product, fallback=self.default_ttl)
+        return ttl
+
+    def make_key(self, product, action, request, account):
+        """按产品、接口、参数和账号生成缓存的key
+
+        argvs:
+            product = "slb"
+            action = "DescribeLoadBalancerAttribute"
+            request: 阿里云sdk的request
+            account = ["LTAxxxx", "cn-beijing"] //账号和地域，不同账号的返回内容不同
+
+        return:
+            key = "3f9a..."
+        """
+
+        query_dict = dict((k, v) for k, v in (request.get_query_params() or {}).items() if k not in self.SIGN_PARAM_SET)
+        content = request.get_content() or b""
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+
+        key_list = [product, action, request.get_version(), account, query_dict, request.get_body_params() or {}, content]
+        return hashlib.sha1(json.dumps(key_list, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def add_stat(self, product, field):
+        """累加命中和未命中的次数"""
+
+        stat_dict = self.stat_dict.setdefault(product, {"hit": 0, "miss": 0})
+        stat_dict[field] += 1
+
+    def get(self, product, key, ttl, change_time=None):
+        """取出缓存时间内的返回内容，资源在缓存之后修改过或者没有缓存时返回None
+
+        argvs:
+            product = "slb"
+            key = "3f9a..."
+            ttl = 600
+            change_time = 1622376664.0 //列表接口中资源的修改时间，None为不知道
+
+        return:
+            response = b'{"LoadBalancerId": "lb-xxxxxxxxxxxxx"}'
+        """
+
+        min_time = time.time() - ttl
+        if change_time is not None:
+            min_time = max(min_time, change_time)
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM api_cache WHERE key = ? AND time >= ?", (key, min_time)).fetchone()
+            self.add_stat(product, "hit" if row else "miss")
+        if row:
+            return bytes(row[0])
+        return None
+
+    def put(self, product, key, response):
+        """保存接口的返回内容
+
+        argvs:
+            product = "slb"
+            key = "3f9a..."
+            response = b'{"LoadBalancerId": "lb-xxxxxxxxxxxxx"}'
+        """
+
+        if isinstance(response, str):
+            response = response.encode('utf-8')
+        with self.lock:
+            self.conn.execute("REPLACE INTO api_cache (key, product, response, time) VALUES (?, ?, ?, ?)",
+                (key, product, sqlite3.Binary(response), time.time()))
+            self.conn.commit()
+
+    def log_stat(self):
+        """输出每个产品缓存的命中和未命中次数"""
+
+        with self.lock:
+            for product, stat_dict in sorted(self.stat_dict.items()):
+                total = stat_dict["hit"] + stat_dict["miss"]
+                self.logging.info(product + "接口缓存命中" + str(stat_dict["hit"]) + "次，未命中" + str(stat_dict["miss"]) + "次，命中率" + str(round(stat_dict["hit"] * 100.0 / total, 1)) + "%")
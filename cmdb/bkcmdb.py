@@ -1,7 +1,7 @@
 from dateutil import parser
 import pymongo, datetime, bson, configparser
 import logging, json, requests, threading
-import sys
+import sys, time, collections
 
 
 class BkCmdb():
@@ -34,6 +34,21 @@ class BkCmdb():
             "bk_username": bk_username,
         }
 
+        #[复用连接的http会话，连接池大小和请求超时]
+        self.http_pool_size = self.cfg.getint('bk', 'http_pool_size', fallback=10)
+        self.http_timeout = self.cfg.getfloat('bk', 'http_timeout', fallback=30)
+        self.session = requests.Session()
+        self.session.headers.update(self.post_header)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.http_pool_size, pool_maxsize=self.http_pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        #[批量创建主机时每次请求的数量]
+        self.create_batch_size = self.cfg.getint('bk', 'create_batch_size', fallback=100)
+
+        #[查询mongodb时每批从服务端取回的文档数量]
+        self.find_batch_size = self.cfg.getint('bk', 'find_batch_size', fallback=1000)
+
         #[mongodb数据库相关内容]
         data_ip = self.cfg['bk']['data_ip']
         data_port = self.cfg['bk']['data_port']
@@ -49,8 +64,121 @@ class BkCmdb():
         self.public_asst_dict = {}
         self.tmp_list = {}
 
+        #[批量删除时每次请求的数量]
+        self.delete_batch_size = self.cfg.getint('bk', 'delete_batch_size', fallback=200)
+
+        #[写入mongodb的缓冲，每个集合一份，达到bulk_size条或者bulk_interval秒时批量写入]
+        self.bulk_size = self.cfg.getint('bk', 'bulk_size', fallback=500)
+        self.bulk_interval = self.cfg.getfloat('bk', 'bulk_interval', fallback=5)
+        self.write_buffer_dict = {}
+        self.write_time_dict = {}
+
+        #写入失败的操作的标识，由调用方用pop_write_fail取走，比如cmdb-master据此让agent重新全量上报
+        self.write_fail_list = []
+
+        #[添加实例关联时用到的缓存：模型关联、匹配字段、按字段建立的实例索引、已存在的实例关联]
+        self.job_asst_dict = {}
+        self.match_field_dict = {}
+        self.field_index_dict = {}
+        self.asst_key_dict = {}
+        self.asst_field_list = ["bk_inst_id", "bk_obj_id", "bk_asst_inst_id", "bk_asst_obj_id", "bk_obj_asst_id", "bk_asst_id"]
+
+        #[实例关联id号段，每次从cc_idgenerator中原子预留asst_id_batch个，在本地分配]
+        self.asst_id_batch = self.cfg.getint('bk', 'asst_id_batch', fallback=100)
+        self.asst_id_next = 0
+        self.asst_id_end = 0
+        self.asst_id_lock = threading.Lock()
+
+        #[模型实例的内存索引，执行load_inst后add_inst直接和索引比对，不再逐条查询]
+        self.inst_index_dict = {}
+
+        #[主机ip到主机id的缓存，第一次查询时整体加载，之后每条超过host_cache_ttl秒过期重新查询，最多保留host_cache_size个]
+        self.host_cache_size = self.cfg.getint('bk', 'host_cache_size', fallback=100000)
+        self.host_cache_ttl = self.cfg.getfloat('bk', 'host_cache_ttl', fallback=600)
+        self.host_id_cache = collections.OrderedDict()
+        self.host_cache_loaded = False
+
+    def find_doc(self, col_name, inq_dict, projection=None, stream=False):
+        """查询集合，可以只取指定字段，stream为True时返回游标边遍历边取，不一次放进列表
+
+        argvs:
+            col_name = "cc_HostBase"
+            inq_dict = {"bk_host_innerip":"1.1.1.1"}
+            projection = {"bk_host_id": 1} //None时返回全部字段
+            stream = False
+
+        return:
+            doc_list = [{"_id": ObjectId("..."), "bk_host_id": 30}]
+        """
+
+        mydoc = self.db[col_name].find(inq_dict, projection).batch_size(self.find_batch_size)
+        if stream:
+            return mydoc
+        return list(mydoc)
+
+    def load_host_id(self):
+        """一次扫描cc_HostBase，只取ip和主机id，预热主机id缓存，只在第一次查询时执行"""
+
+        mycol = self.db['cc_HostBase']
+        mydoc = mycol.find({}, {"bk_host_innerip": 1, "bk_host_id": 1})
+
+        self.host_id_cache.clear()
+        self.host_cache_loaded = True
+        for i in mydoc:
+            if i.get("bk_host_innerip"):
+                self.cache_host_id(i["bk_host_innerip"], i["bk_host_id"])
+        logging.info("加载主机id缓存:" + str(len(self.host_id_cache)) + "台")
+
+    def cache_host_id(self, host_ip, host_id):
+        """记录主机id和过期时间到缓存，超过数量时淘汰最久没有用到的
+
+        argvs:
+            host_ip = "1.1.1.1"
+            host_id = 30
+        """
+
+        self.host_id_cache[host_ip] = (host_id, time.time() + self.host_cache_ttl)
+        self.host_id_cache.move_to_end(host_ip)
+        while len(self.host_id_cache) > self.host_cache_size:
+            self.host_id_cache.popitem(last=False)
+
+    def get_cache_host_id(self, host_ip):
+        """从缓存中取主机id，第一次查询时先整体加载，不在缓存中或者已经过期返回0，由调用方重新查询
+
+        argvs:
+            host_ip = "1.1.1.1"
+
+        return:
+            host_id = 30
+        """
+
+        if not self.host_cache_loaded:
+            self.load_host_id()
+
+        cache_info = self.host_id_cache.get(host_ip)
+        if not cache_info:
+            return 0
+
+        #过期的去掉，主机可能已经在别处删除或者重建
+        host_id, expire_time = cache_info
+        if time.time() >= expire_time:
+            del self.host_id_cache[host_ip]
+            return 0
+
+        self.host_id_cache.move_to_end(host_ip)
+        return host_id
+
+    def del_cache_host_id(self, host_ip):
+        """主机删除后从缓存中去掉
+
+        argvs:
+            host_ip = "1.1.1.1"
+        """
+
+        self.host_id_cache.pop(host_ip, None)
+
     def get_host_id(self, inq_dict):
-        """根据字典来查询主机id，不存在主机则返回0
+        """根据字典来查询主机id，不存在主机则返回0，只按ip查询时先查缓存
     
         argvs:
             inq_dict = {"bk_host_innerip":"1.1.1.1"}
@@ -59,58 +187,140 @@ class BkCmdb():
             host_id = 30
         """
 
+        host_ip = inq_dict.get("bk_host_innerip") if len(inq_dict) == 1 else None
+        if host_ip:
+            host_id = self.get_cache_host_id(host_ip)
+            if host_id:
+                return host_id
+
         mycol = self.db['cc_HostBase']
-        mydoc = mycol.find(inq_dict)
+        mydoc = mycol.find_one(inq_dict, {"bk_host_id": 1})
 
         try:
-            host_id = mydoc[0]['bk_host_id']
+            host_id = mydoc['bk_host_id']
         except:
             host_id = 0
+
+        if host_ip and host_id:
+            self.cache_host_id(host_ip, host_id)
         return host_id
 
+    def get_host_id_dict(self, host_ip_list):
+        """一次查询多个ip对应的主机id，不存在的ip不在返回结果中，缓存中没有或者已经过期的ip合并成一次查询
+
+        argvs:
+            host_ip_list = ["1.1.1.1", "1.1.1.2"]
+
+        return:
+            host_id_dict = {"1.1.1.1": 30}
+        """
+
+        host_id_dict = {}
+        miss_ip_list = []
+        for host_ip in host_ip_list:
+            host_id = self.get_cache_host_id(host_ip)
+            if host_id:
+                host_id_dict[host_ip] = host_id
+            else:
+                miss_ip_list.append(host_ip)
+        if not miss_ip_list:
+            return host_id_dict
+
+        mycol = self.db['cc_HostBase']
+        myquery = {"bk_host_innerip": {"$in": miss_ip_list}}
+        mydoc = mycol.find(myquery, {"bk_host_innerip": 1, "bk_host_id": 1})
+
+        for i in mydoc:
+            if i["bk_host_innerip"] not in host_id_dict:
+                host_id_dict[i["bk_host_innerip"]] = i["bk_host_id"]
+                self.cache_host_id(i["bk_host_innerip"], i["bk_host_id"])
+        return host_id_dict
+
+    def post_api(self, api_name, inq_dict):
+        """通过会话调用蓝鲸ESB接口，请求内容为认证信息加上传入的字段，不修改self.post_data
+
+        argvs:
+            api_name = "create_inst"
+            inq_dict = {"bk_obj_id": "bk_slb"}
+
+        return:
+            bk_req = {"result": True, "data": {}}
+        """
+
+        req_data = dict(self.post_data, **inq_dict)
+        url = self.bk_url + "/api/c/compapi/v2/cc/" + api_name + "/"
+        req = self.session.post(url, data=json.dumps(req_data), timeout=self.http_timeout)
+        return req.json()
+
+    def create_hosts(self, host_ip_list):
+        """批量创建主机，每次请求create_batch_size台，返回新主机的id并记录到缓存
+
+        argvs:
+            host_ip_list = ["1.1.1.1", "1.1.1.2"]
+
+        return:
+            host_id_dict = {"1.1.1.1": 30} //创建失败的ip不在其中
+        """
+
+        for i in range(0, len(host_ip_list), self.create_batch_size):
+            batch_list = host_ip_list[i:i + self.create_batch_size]
+
+            host_info = {}
+            for index, host_ip in enumerate(batch_list):
+                host_info[str(index)] = {
+                    "bk_host_innerip": host_ip,
+                    "bk_cloud_id": 0,
+                    "import_from": "3"
+                }
+
+            bk_req = self.post_api("add_host_to_resource", {"bk_biz_id": 3, "host_info": host_info})
+            logging.info("创建主机:" + ",".join(batch_list))
+            logging.debug(bk_req)
+
+        #接口不返回主机id，创建后按ip查一次并记录到缓存
+        for host_ip in host_ip_list:
+            self.del_cache_host_id(host_ip)
+        return self.get_host_id_dict(host_ip_list)
+
     def create_host(self, host_ip):
-        """创建主机
+        """创建主机，返回新主机的id并记录到缓存，创建失败返回0
 
         argvs:
             host_ip = "1.1.1.1"
+
+        return:
+            host_id = 30
         """
 
-        req_data = self.post_data
-        req_data["bk_biz_id"] = 3
-        req_data["host_info"] = {
-            "0": {
-                "bk_host_innerip": host_ip,
-                "bk_cloud_id": 0,
-                "import_from": "3"
-            }
-        }
+        return self.create_hosts([host_ip]).get(host_ip, 0)
+
+    def delete_host(self, host_id, host_ip):
+        """删除主机，并从主机id缓存中去掉
+
+        argvs:
+            host_id = 30
+            host_ip = "1.1.1.1"
+        """
 
-        url = self.bk_url + "/api/c/compapi/v2/cc/add_host_to_resource/"
-        req = requests.post(url, data=json.dumps(req_data), headers=self.post_header)
-        bk_req = req.json()
+        bk_req = self.post_api("delete_host", {"bk_supplier_account": "0", "bk_host_id": str(host_id)})
+        self.del_cache_host_id(host_ip)
 
-        logging.info("创建主机:" + host_ip)
+        logging.info("删除主机:" + host_ip)
         logging.debug(bk_req)
 
-    def get_host(self, inq_dict):
+    def get_host(self, inq_dict, projection=None, stream=False):
         """根据查询字段来查询主机信息
 
         argvs:
-            inq_dict = {"bk_host_type":"0"}
+            inq_dict = {"bk_host_innerip":"192.168.1.2"}
+            projection = {"bk_host_name": 1} //只取需要的字段，None时返回全部字段
+            stream = False //True时返回游标，边遍历边取
 
         return:
-            host_info_list = ["bk_host_type":"0"]
+            host_info_list = [{"bk_host_innerip":"192.168.1.2"}]
         """
 
-        mycol = self.db['cc_HostBase']
-        mydoc = mycol.find(inq_dict)
-
-        mydoc = mycol.find(inq_dict)
-
-        host_info_list = []
-        for i in mydoc:
-            host_info_list.append(i)
-        return host_info_list
+        return self.find_doc('cc_HostBase', inq_dict, projection, stream)
 
     def update_host(self, host_id, inq_dict):
         """更新主机
@@ -120,13 +330,79 @@ class BkCmdb():
             inq_dict = {"bk_host_type":"0"}
         """
 
-        mycol = self.db['cc_HostBase']
         myquery = {"bk_host_id": host_id}
         newvalues = {"$set": inq_dict}
-        mycol.update_one(myquery, newvalues)
- 
-        logging.info("更新主机:" + str(host_id))
-        logging.debug(inq_dict)
+        self.add_write('cc_HostBase', pymongo.UpdateOne(myquery, newvalues), "更新主机:" + str(host_id), inq_dict, host_id)
+
+    def add_write(self, col_name, operation, log_msg, log_data, write_key=None):
+        """把写操作放入缓冲，达到数量或者时间阈值时批量写入，其他集合的缓冲超过时间阈值也一起写入
+
+        写入都在调用线程中进行，一轮同步结束时要调用flush_write把剩下的写入
+
+        argvs:
+            col_name = "cc_HostBase" //集合名称
+            operation = pymongo.UpdateOne({"bk_host_id": 3}, {"$set": {"bk_host_type":"0"}})
+            log_msg = "更新主机:3" //写入成功后显示的日志
+            log_data = {"bk_host_type":"0"} //debug日志显示的内容
+            write_key = 3 //写入失败时记录到write_fail_list中的标识，None为不记录
+        """
+
+        buffer_list = self.write_buffer_dict.setdefault(col_name, [])
+        if not buffer_list:
+            self.write_time_dict[col_name] = time.time()
+        buffer_list.append((operation, log_msg, log_data, write_key))
+
+        if len(buffer_list) >= self.bulk_size:
+            self.flush_write(col_name)
+
+        #每次写操作时检查所有集合的缓冲时间，长时间没有新写操作的集合不会一直留在缓冲里
+        for buffer_name in list(self.write_buffer_dict.keys()):
+            if self.write_buffer_dict[buffer_name] and time.time() - self.write_time_dict[buffer_name] >= self.bulk_interval:
+                self.flush_write(buffer_name)
+
+    def flush_write(self, col_name=None):
+        """把缓冲中的写操作无序批量写入，失败的操作单独显示错误
+
+        argvs:
+            col_name = "cc_HostBase" //为None时写入所有集合
+        """
+
+        if col_name is None:
+            col_name_list = list(self.write_buffer_dict.keys())
+        else:
+            col_name_list = [col_name]
+
+        for col_name in col_name_list:
+            buffer_list = self.write_buffer_dict.pop(col_name, [])
+            if not buffer_list:
+                continue
+
+            error_dict = {}
+            try:
+                self.db[col_name].bulk_write([i[0] for i in buffer_list], ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                for error in e.details["writeErrors"]:
+                    error_dict[error["index"]] = error["errmsg"]
+
+            for index, (operation, log_msg, log_data, write_key) in enumerate(buffer_list):
+                if index in error_dict:
+                    logging.error(log_msg + " 写入失败:" + error_dict[index])
+                    if write_key is not None:
+                        self.write_fail_list.append(write_key)
+                else:
+                    logging.info(log_msg)
+                logging.debug(log_data)
+
+    def pop_write_fail(self):
+        """取出并清空写入失败的操作的标识
+
+        return:
+            write_fail_list = [3, 5] //update_host写入失败的主机id
+        """
+
+        write_fail_list = self.write_fail_list
+        self.write_fail_list = []
+        return write_fail_list
 
     def get_host_mod(self, host_id):
         """根据主机id查询绑定了哪些模块的id号
@@ -139,19 +415,20 @@ class BkCmdb():
         """
 
         mod_id_list = []
-        mycol = self.db['cc_ModuleHostConfig']
         myquery = { "bk_host_id": host_id }
-        mydoc = mycol.find(myquery)
+        mydoc = self.find_doc('cc_ModuleHostConfig', myquery, {"_id": 0, "bk_module_id": 1}, stream=True)
 
         for x in mydoc:
             mod_id_list.append(x['bk_module_id'])
         return mod_id_list
 
-    def get_mod(self, inq_dict):
+    def get_mod(self, inq_dict, projection=None, stream=False):
         """根据查询字典来获取模块信息
     
         argvs:
             inq_dict = {"bk_module_id": "32"}
+            projection = {"bk_module_name": 1} //只取需要的字段，None时返回全部字段
+            stream = False //True时返回游标，边遍历边取
 
         return:
             mod_info_list = [
@@ -165,13 +442,7 @@ class BkCmdb():
             ]
         """
 
-        mycol = self.db['cc_ModuleBase']
-        mydoc = mycol.find(inq_dict)
-
-        mod_info_list = []
-        for i in mydoc:
-            mod_info_list.append(i)
-        return mod_info_list
+        return self.find_doc('cc_ModuleBase', inq_dict, projection, stream)
 
     def get_mod_proc(self, mod_name):
         """根据模块名称获取所绑定这个模块的进程id号
@@ -183,9 +454,8 @@ class BkCmdb():
             proc_id_list = [32, 45]
         """
 
-        mycol = self.db['cc_Proc2Module']
         myquery = { "bk_module_name": mod_name }
-        mydoc = mycol.find(myquery)
+        mydoc = self.find_doc('cc_Proc2Module', myquery, {"_id": 0, "bk_process_id": 1}, stream=True)
 
         proc_id_list = []
         for i in mydoc:
@@ -200,10 +470,9 @@ class BkCmdb():
             inq_dict = {"bk_module_name": "database"}
         """
 
-        mycol = self.db['cc_ModuleBase']
         myquery = { "bk_module_id": mod_id }
         newvalues = { "$set": inq_dict }
-        mycol.update_one(myquery, newvalues)
+        self.add_write('cc_ModuleBase', pymongo.UpdateOne(myquery, newvalues), "更新模块:" + str(mod_id), inq_dict)
 
     def create_inst(self, inq_dict):
         """根据字典来创建实例，字典中为模型字段
@@ -212,17 +481,18 @@ class BkCmdb():
             inq_dict = {"bk_inst_name":"生产-会员-内网"}
         """
 
-        req_data = self.post_data
-        req_data["bk_supplier_account"] = 0
-        req_data = dict(req_data, **inq_dict)
-
-        url = self.bk_url + "/api/c/compapi/v2/cc/create_inst/"
-        req = requests.post(url, data=json.dumps(req_data), headers=self.post_header)
-        bk_req = req.json()
+        bk_req = self.post_api("create_inst", dict({"bk_supplier_account": 0}, **inq_dict))
         logging.info("创建实例:" + inq_dict["bk_inst_name"])
         logging.debug(inq_dict)
         logging.debug(bk_req)
 
+        try:
+            inst_id = bk_req["data"]["bk_inst_id"]
+        except:
+            logging.error("创建实例失败:" + inq_dict["bk_inst_name"] + " " + str(bk_req.get("message")))
+            inst_id = 0
+        return inst_id
+
     def update_inst(self, inq_dict):
         """根据传入的信息，对实例进行更新
 
@@ -230,15 +500,12 @@ class BkCmdb():
             inq_dict = {"bk_inst_name":"生产-会员-内网", "bk_id" = "lb-xxxxxxxxxxx"}
         """
 
-        logging.info("更新实例:" + inq_dict["bk_inst_name"])
-        logging.debug(inq_dict)
-
-        #通过名称匹配去更新其它数据
-        mycol = self.db['cc_ObjectBase']
+        #通过名称匹配去更新其它数据，复制一份，不修改传入的字典
         myquery = { "bk_inst_name": inq_dict["bk_inst_name"] }
-        del inq_dict["bk_inst_name"]
-        newvalues = { "$set": inq_dict }
-        mycol.update_one(myquery, newvalues)
+        set_dict = dict(inq_dict)
+        del set_dict["bk_inst_name"]
+        newvalues = { "$set": set_dict }
+        self.add_write('cc_ObjectBase', pymongo.UpdateOne(myquery, newvalues), "更新实例:" + inq_dict["bk_inst_name"], inq_dict)
 
     def add_inst(self, inq_dict):
         """添加inst信息
@@ -247,36 +514,76 @@ class BkCmdb():
             inq_dict = {"bk_inst_name":"生产-会员-内网"}
         """
 
+        bk_obj_id = inq_dict["bk_obj_id"]
+
+        #加载过索引的模型，直接和索引比对
+        inst_index = self.inst_index_dict.get(bk_obj_id)
+        if inst_index is not None:
+            inst_info = inst_index.get(inq_dict["bk_inst_name"])
+            if inst_info is None:
+                inst_info = dict(inq_dict)
+                inst_info["bk_inst_id"] = self.create_inst(inq_dict)
+
+                #创建失败时不放入索引，后面再添加时重新创建
+                if inst_info["bk_inst_id"]:
+                    inst_index[inq_dict["bk_inst_name"]] = inst_info
+                    self.update_field_index(bk_obj_id, inst_info)
+            elif any(inst_info.get(k) != v for k, v in inq_dict.items()):
+                self.update_inst(inq_dict)
+                old_info = dict(inst_info)
+                inst_info.update(inq_dict)
+                self.update_field_index(bk_obj_id, inst_info, old_info)
+
         #先查询全额数据，看是否有完全一致的
-        if not self.get_inst(inq_dict):
+        elif not self.get_inst(inq_dict, {"bk_inst_id": 1}):
             tmp_inq_dict = {}
             tmp_inq_dict["bk_inst_name"] = inq_dict["bk_inst_name"]
             
             #再只查询是否有这个名称的实例
-            if self.get_inst(tmp_inq_dict):
+            if self.get_inst(tmp_inq_dict, {"bk_inst_id": 1}):
                 self.update_inst(inq_dict)
             else:
                 self.create_inst(inq_dict)
 
-        bk_obj_id = inq_dict["bk_obj_id"]
+            #没有加载实例索引，字段索引已经不准确，下次用到时重新加载
+            for key in [key for key in self.field_index_dict.keys() if key[0] == bk_obj_id]:
+                del self.field_index_dict[key]
+
         self.public_inst_dict[bk_obj_id].append(inq_dict)
 
-    def get_inst(self, inq_dict):
+    def load_inst(self, bk_obj_id):
+        """一次性加载模型下的所有实例，建立以bk_inst_name为key的索引
+
+        argvs:
+            bk_obj_id = "bk_slb"
+
+        return:
+            inst_index = {"生产-会员-内网": {"bk_inst_name":"生产-会员-内网", "bk_inst_id": 28}}
+        """
+
+        inst_index = {}
+        for inst_info in self.get_inst({"bk_obj_id": bk_obj_id}):
+            if "bk_inst_name" in inst_info:
+                inst_index[inst_info["bk_inst_name"]] = inst_info
+
+        self.inst_index_dict[bk_obj_id] = inst_index
+        self.field_index_dict[(bk_obj_id, "bk_inst_name")] = inst_index
+        logging.info("加载" + bk_obj_id + "模型实例" + str(len(inst_index)) + "个")
+        return inst_index
+
+    def get_inst(self, inq_dict, projection=None, stream=False):
         """根据输入的字段查询实例信息
 
         argvs:
             inq_dict = {"bk_inst_name":"生产-会员-内网"}
+            projection = {"bk_inst_id": 1} //只取需要的字段，None时返回全部字段
+            stream = False //True时返回游标，边遍历边取
 
         return:
             inst_info_list = [{"bk_inst_name":"生产-会员-内网"}]
         """
-        mycol = self.db['cc_ObjectBase']
-        mydoc = mycol.find(inq_dict)
 
-        inst_info_list = []
-        for i in mydoc:
-            inst_info_list.append(i)
-        return inst_info_list
+        return self.find_doc('cc_ObjectBase', inq_dict, projection, stream)
 
     def del_inst(self, bk_obj_id, inst_id, bk_inst_name):
         """删除实例
@@ -286,90 +593,98 @@ class BkCmdb():
             inst_id = 28 //实例的id号
             bk_inst_name = "生产-会员-内网" //实例名称，用于显示
         """
-        req_data = self.post_data
-        req_data["bk_supplier_account"] = 0
-        req_data["bk_obj_id"] = bk_obj_id
-        req_data["delete"] = {"inst_ids":[inst_id]}
 
-        url = self.bk_url + "/api/c/compapi/v2/cc/batch_delete_inst/"
-        req = requests.post(url, data=json.dumps(req_data), headers=self.post_header)
-        bk_req = req.json()
+        self.batch_del_inst(bk_obj_id, [{"bk_inst_id": inst_id, "bk_inst_name": bk_inst_name}])
 
-        logging.info("删除实例:" + bk_inst_name )
-        logging.debug(bk_req)
+    def batch_del_inst(self, bk_obj_id, inst_info_list):
+        """批量删除实例，按delete_batch_size分批请求
+
+        argvs:
+            bk_obj_id = bk_slb //模型id
+            inst_info_list = [{"bk_inst_id": 28, "bk_inst_name": "生产-会员-内网"}]
+        """
+
+        for i in range(0, len(inst_info_list), self.delete_batch_size):
+            batch_list = inst_info_list[i:i + self.delete_batch_size]
+
+            req_data = {
+                "bk_supplier_account": 0,
+                "bk_obj_id": bk_obj_id,
+                "delete": {"inst_ids":[inst_info["bk_inst_id"] for inst_info in batch_list]}
+            }
+            bk_req = self.post_api("batch_delete_inst", req_data)
+
+            for inst_info in batch_list:
+                logging.info("删除实例:" + inst_info["bk_inst_name"])
+            logging.debug(bk_req)
 
-    def get_asst(self, inq_dict):
+    def get_asst(self, inq_dict, projection=None, stream=False):
         """根据查询字典，找到对应实例之间的关联信息
 
         argvs:
             inq_dict = {"bk_obj_id":"bk_slb"}
+            projection = {"id": 1} //只取需要的字段，None时返回全部字段
+            stream = False //True时返回游标，边遍历边取
 
         return:
             asst_info_list = [{"bk_obj_id":"bk_slb"}]
         """
 
-        mycol = self.db['cc_InstAsst']
-        mydoc = mycol.find(inq_dict)
-
-        #写到数组里
-        asst_info_list = []
-        for i in mydoc:
-            asst_info_list.append(i)
-        return asst_info_list
+        return self.find_doc('cc_InstAsst', inq_dict, projection, stream)
 
-    def get_job_asst(self, inq_dict):
+    def get_job_asst(self, inq_dict, projection=None, stream=False):
         """查询模型间的关联信息
 
         argvs:
             inq_dict = {"bk_obj_id":"bk_slb"}
+            projection = {"bk_asst_obj_id": 1} //只取需要的字段，None时返回全部字段
+            stream = False //True时返回游标，边遍历边取
 
         return:
             job_asst_list = [{"bk_obj_id":"bk_slb"}]
         """
 
-        mycol = self.db['cc_ObjAsst']
-        mydoc = mycol.find(inq_dict)
+        return self.find_doc('cc_ObjAsst', inq_dict, projection, stream)
 
-        #写到数组里
-        job_asst_list = []
-        for i in mydoc:
-            job_asst_list.append(i)
-        return job_asst_list
+    def reserve_asst_id(self, count):
+        """在cc_idgenerator中原子预留一段实例关联的id号，和cmdb自身分配id用的是同一个计数器
 
-    def get_asst_lastid(self):
-        """获取实例中最后可用的id号
+        argvs:
+            count = 100
 
         return:
-            asst_id = 129
+            (asst_id_start, asst_id_end) = (130, 229)
         """
 
-        mycol = self.db['cc_InstAsst']
-        mydoc = mycol.find().sort('_id', -1).limit(1)
-        try:
-            asst_id = mydoc[0]["id"]        
-        except:
-            asst_id = 0
-        asst_id = asst_id + 1
-        return asst_id
+        mycol = self.db['cc_idgenerator']
 
-    def get_host(self, inq_dict):
-        """查询主机信息
+        #第一次预留时，计数器不能小于已经存在的最大id
+        if not self.asst_id_end:
+            mydoc = self.db['cc_InstAsst'].find().sort('id', -1).limit(1)
+            try:
+                asst_id = mydoc[0]["id"]
+            except:
+                asst_id = 0
+            mycol.update_one({"_id": "cc_InstAsst"}, {"$max": {"SequenceID": asst_id}}, upsert=True)
 
-        argvs:
-            inq_dict = {"bk_host_innerip":"192.168.1.2"}
+        mydoc = mycol.find_one_and_update({"_id": "cc_InstAsst"}, {"$inc": {"SequenceID": count}},
+            upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        asst_id_end = mydoc["SequenceID"]
+        return asst_id_end - count + 1, asst_id_end
+
+    def get_asst_lastid(self):
+        """获取一个可用的实例关联id号，本地号段用完时再预留一段
 
         return:
-            host_info_list = [{"bk_host_innerip":"192.168.1.2"}]
+            asst_id = 129
         """
 
-        mycol = self.db['cc_HostBase']
-        mydoc = mycol.find(inq_dict)
-
-        #写到数组里
-        host_info_list = []
-        for i in mydoc:
-            host_info_list.append(i)
-        return host_info_list
+        with self.asst_id_lock:
+            if self.asst_id_next == 0 or self.asst_id_next > self.asst_id_end:
+                self.asst_id_next, self.asst_id_end = self.reserve_asst_id(self.asst_id_batch)
+            asst_id = self.asst_id_next
+            self.asst_id_next += 1
+        return asst_id
 
     def create_asst(self, asst_id, inq_dict):
         """添加实例之家的关联信息
@@ -385,7 +700,6 @@ class BkCmdb():
         last_time = "0001-01-01T00:00:00Z"
         last_time = parser.parse(last_time)
 
-        mycol = self.db['cc_InstAsst']
         mydict = {
             "bk_supplier_account" : "0", 
             "create_time" : create_time, 
@@ -396,96 +710,228 @@ class BkCmdb():
         mydict["bk_inst_id"] = bson.int64.Int64(inq_dict["bk_inst_id"])
         mydict["bk_asst_inst_id"] = bson.int64.Int64(inq_dict["bk_asst_inst_id"])
 
-        mydoc = mycol.insert_one(mydict)
-        logging.info("添加实例id" + str(inq_dict["bk_obj_id"]) + "到实例id" + str(inq_dict["bk_obj_asst_id"]) + "的关联信息")
-        logging.debug(mydict)
-        logging.debug(mydoc)
+        log_msg = "添加实例id" + str(inq_dict["bk_obj_id"]) + "到实例id" + str(inq_dict["bk_obj_asst_id"]) + "的关联信息"
+        self.add_write('cc_InstAsst', pymongo.InsertOne(mydict), log_msg, mydict)
 
-    def add_asst(self, bk_obj_id, bk_inst_name, bk_dest_keyword):
-        """添加实例关联关系
+        #缓冲中的数据在mongodb里还查不到，先记录下来
+        if inq_dict["bk_obj_id"] in self.asst_key_dict:
+            self.asst_key_dict[inq_dict["bk_obj_id"]].add(self.make_key(inq_dict, self.asst_field_list))
+
+    def get_model_asst(self, bk_obj_id):
+        """获取模型对应的模型关联信息，每个模型只查询一次
 
         argvs:
             bk_obj_id = "bk_slb"
-            bk_inst_name = "生产-会员-内网"
-            bk_dest_keyword = "172.16.1.2" //目标实例的关键字
+
+        return:
+            job_asst_list = [{"bk_obj_id":"bk_slb", "bk_asst_obj_id":"host"}]
         """
 
-        #查询实例信息
-        inst_info_list = []
+        if bk_obj_id not in self.job_asst_dict:
+            self.job_asst_dict[bk_obj_id] = self.get_job_asst({"bk_obj_id": bk_obj_id})
+        return self.job_asst_dict[bk_obj_id]
 
-        #模型对应的模型关联信息
-        inq_dict = {"bk_obj_id": bk_obj_id}
-        job_asst_list = self.get_job_asst(inq_dict)
+    def get_match_field(self, bk_asst_obj_id):
+        """获取目标模型用来匹配实例的字段，配置文件中没有则只用bk_inst_name
 
-        #循环根据模型关系去找，例如和host、bk_tools模型绑定，那就循环查2次
-        for asst_info_dict in job_asst_list:
-            #先检测是否有东西，要退出2层break
-            if inst_info_list:
-                break
+        argvs:
+            bk_asst_obj_id = "host"
+
+        return:
+            match_field_list = ["bk_aliyun_id", "bk_host_innerip", "bk_inst_name"]
+        """
 
-            #查找配置文件，没有则是空的
+        if bk_asst_obj_id not in self.match_field_dict:
             try:
-                match_field = self.cfg['bk_mod_field'][asst_info_dict["bk_asst_obj_id"]]
+                match_field = self.cfg['bk_mod_field'][bk_asst_obj_id]
                 match_field_list = match_field.split(',')
             except:
                 match_field_list = []
             match_field_list.append("bk_inst_name")
+            self.match_field_dict[bk_asst_obj_id] = match_field_list
+        return self.match_field_dict[bk_asst_obj_id]
 
-            if match_field_list:
-                #循环根据字段与值，去找这个实例是谁，放入列表中
-                for inq_field in match_field_list:
-                    if asst_info_dict["bk_asst_obj_id"] == "host":
-                        inq_dict = {inq_field:bk_dest_keyword}
-                        inst_info_list = self.get_host(inq_dict)
-                    else:
-                        #对于其它实例就要指定下这个实例的模型是啥
-                        inq_dict = {inq_field:bk_dest_keyword, "bk_obj_id":asst_info_dict["bk_asst_obj_id"]}
-                        inst_info_list =  self.get_inst(inq_dict)
-                    #里面只可能有一个字段是匹配到值了，所以有了值就 并退出循环
-                    if inst_info_list:
-                        inst_info_list.append(asst_info_dict["bk_asst_obj_id"])
-                        inst_info_list.append(asst_info_dict["bk_obj_asst_id"])
-                        inst_info_list.append(asst_info_dict["bk_asst_id"])
-                        break
-
-        #查看是否有值，有则查看实例关联关系是否已经存在
-        if inst_info_list:
-            #这里取出源实例的id号
-            if bk_obj_id == "host":
-                inq_dict = {"bk_host_innerip": bk_inst_name}
-                src_inst_info = self.get_host(inq_dict)
-            else:
-                inq_dict = {"bk_inst_name" : bk_inst_name}
-                src_inst_info = self.get_inst(inq_dict)
-            src_inst_id = src_inst_info[0]["bk_inst_id"]
-
-            #找到目标实例的id号
-            if inst_info_list[1] == "host":
-                dest_inst_id = inst_info_list[0]["bk_host_id"]
-                bk_asst_obj_id = "host"
-            else:
-                dest_inst_id = inst_info_list[0]["bk_inst_id"]
-                bk_asst_obj_id = inst_info_list[0]["bk_obj_id"]
-
-            #拿出关联信息，原实例对应的，然后重组筛选放到
-            inq_dict = {
-                "bk_inst_id":src_inst_id, 
-                "bk_obj_id":bk_obj_id, 
-                "bk_asst_inst_id":dest_inst_id,
-                "bk_asst_obj_id":bk_asst_obj_id,
-                "bk_obj_asst_id":inst_info_list[2],
-                "bk_asst_id":inst_info_list[3]
-            }
-            inst_asst_dict = self.get_asst(inq_dict)
-            if not inst_asst_dict:
-                #获取唯一的id号
-                asst_id = self.get_asst_lastid()
-                self.create_asst(asst_id, inq_dict)
-
-            #加到公共列表
-            self.public_asst_dict[bk_obj_id].append(inq_dict)
+    def load_field_index(self, bk_obj_id, field):
+        """一次性加载模型中某个字段的值，建立字段值到实例的索引，host模型查询主机表
+
+        argvs:
+            bk_obj_id = "host"
+            field = "bk_host_innerip"
+
+        return:
+            field_index = {"172.16.1.2": {"bk_host_innerip": "172.16.1.2", "bk_host_id": 3}}
+        """
+
+        if bk_obj_id == "host":
+            mydoc = self.db['cc_HostBase'].find({field: {"$exists": True}}, {field: 1, "bk_host_id": 1})
         else:
+            myquery = {"bk_obj_id": bk_obj_id, field: {"$exists": True}}
+            mydoc = self.db['cc_ObjectBase'].find(myquery, {field: 1, "bk_inst_id": 1, "bk_obj_id": 1})
+
+        #有重复值时和逐条查询一样，取第一个，没有id的不能用于关联
+        id_field = "bk_host_id" if bk_obj_id == "host" else "bk_inst_id"
+        field_index = {}
+        for info_dict in mydoc:
+            if not info_dict.get(id_field):
+                continue
+            try:
+                field_index.setdefault(info_dict[field], info_dict)
+            except TypeError:
+                continue
+
+        self.field_index_dict[(bk_obj_id, field)] = field_index
+        return field_index
+
+    def update_field_index(self, bk_obj_id, inst_info, old_info=None):
+        """实例创建或者更新后，同步已经加载的字段索引
+
+        argvs:
+            bk_obj_id = "bk_slb"
+            inst_info = {"bk_inst_name":"生产-会员-内网", "bk_ip": "10.0.99.1", "bk_inst_id": 28}
+            old_info = {"bk_inst_name":"生产-会员-内网", "bk_ip": "10.0.99.2", "bk_inst_id": 28} //更新前的实例
+        """
+
+        #创建失败的实例id为0，不放入索引
+        if not inst_info.get("bk_inst_id"):
+            return
+
+        for (index_obj_id, field), field_index in self.field_index_dict.items():
+            if index_obj_id != bk_obj_id:
+                continue
+            try:
+                if old_info and field in old_info:
+                    old_index_info = field_index.get(old_info[field])
+                    if old_index_info and old_index_info.get("bk_inst_id") == inst_info.get("bk_inst_id"):
+                        del field_index[old_info[field]]
+                if field in inst_info:
+                    field_index.setdefault(inst_info[field], inst_info)
+            except TypeError:
+                continue
+
+    def find_inst(self, bk_obj_id, field, value):
+        """从字段索引中查找实例，索引不存在时先加载
+
+        argvs:
+            bk_obj_id = "host"
+            field = "bk_host_innerip"
+            value = "172.16.1.2"
+
+        return:
+            inst_info = {"bk_host_innerip": "172.16.1.2", "bk_host_id": 3} //没有则为None
+        """
+
+        field_index = self.field_index_dict.get((bk_obj_id, field))
+        if field_index is None:
+            field_index = self.load_field_index(bk_obj_id, field)
+        try:
+            inst_info = field_index.get(value)
+        except TypeError:
+            return None
+
+        #id为0的是创建失败的实例，不能作为关联的两端
+        if inst_info and not (inst_info.get("bk_host_id") or inst_info.get("bk_inst_id")):
+            return None
+        return inst_info
+
+    def get_asst_key(self, bk_obj_id):
+        """获取模型已存在的实例关联key集合，每个模型只查询一次
+
+        argvs:
+            bk_obj_id = "bk_slb"
+
+        return:
+            asst_key_set = {frozenset({("bk_obj_id", "bk_slb")})}
+        """
+
+        if bk_obj_id not in self.asst_key_dict:
+            asst_key_set = set()
+            for asst_info_dict in self.get_asst({"bk_obj_id": bk_obj_id}, stream=True):
+                asst_key_set.add(self.make_key(asst_info_dict, self.asst_field_list))
+            self.asst_key_dict[bk_obj_id] = asst_key_set
+        return self.asst_key_dict[bk_obj_id]
+
+    def add_asst(self, bk_obj_id, bk_inst_name, bk_dest_keyword):
+        """添加实例关联关系
+
+        argvs:
+            bk_obj_id = "bk_slb"
+            bk_inst_name = "生产-会员-内网"
+            bk_dest_keyword = "172.16.1.2" //目标实例的关键字
+        """
+
+        #循环根据模型关系去找，例如和host、bk_tools模型绑定，按配置的字段依次匹配，找到就退出
+        dest_info = None
+        for asst_info_dict in self.get_model_asst(bk_obj_id):
+            for inq_field in self.get_match_field(asst_info_dict["bk_asst_obj_id"]):
+                dest_info = self.find_inst(asst_info_dict["bk_asst_obj_id"], inq_field, bk_dest_keyword)
+                if dest_info:
+                    break
+            if dest_info:
+                break
+
+        if not dest_info:
             logging.warn(bk_inst_name + "实例没有找到与之关联的其它实例，请手工创建" + bk_dest_keyword)
+            return
+
+        #这里取出源实例的id号
+        if bk_obj_id == "host":
+            src_inst_info = self.find_inst("host", "bk_host_innerip", bk_inst_name)
+            src_id_field = "bk_host_id"
+        else:
+            src_inst_info = self.find_inst(bk_obj_id, "bk_inst_name", bk_inst_name)
+            src_id_field = "bk_inst_id"
+        if not src_inst_info:
+            logging.warn(bk_inst_name + "实例在cmdb中不存在，跳过关联" + bk_dest_keyword)
+            return
+        src_inst_id = src_inst_info[src_id_field]
+
+        #找到目标实例的id号
+        bk_asst_obj_id = asst_info_dict["bk_asst_obj_id"]
+        if bk_asst_obj_id == "host":
+            dest_inst_id = dest_info["bk_host_id"]
+        else:
+            dest_inst_id = dest_info["bk_inst_id"]
+
+        #拿出关联信息，原实例对应的，然后重组筛选放到
+        inq_dict = {
+            "bk_inst_id":src_inst_id, 
+            "bk_obj_id":bk_obj_id, 
+            "bk_asst_inst_id":dest_inst_id,
+            "bk_asst_obj_id":bk_asst_obj_id,
+            "bk_obj_asst_id":asst_info_dict["bk_obj_asst_id"],
+            "bk_asst_id":asst_info_dict["bk_asst_id"]
+        }
+        if self.make_key(inq_dict, self.asst_field_list) not in self.get_asst_key(bk_obj_id):
+            #获取唯一的id号
+            asst_id = self.get_asst_lastid()
+            self.create_asst(asst_id, inq_dict)
+
+        #加到公共列表
+        self.public_asst_dict[bk_obj_id].append(inq_dict)
+
+    def batch_add_asst(self, bk_obj_id, asst_list):
+        """批量添加实例关联关系，添加完一起写入
+
+        argvs:
+            bk_obj_id = "bk_slb"
+            asst_list = [("生产-会员-内网", "172.16.1.2")] //源实例名称和目标实例的关键字
+        """
+
+        for bk_inst_name, bk_dest_keyword in asst_list:
+            self.add_asst(bk_obj_id, bk_inst_name, bk_dest_keyword)
+        self.flush_write('cc_InstAsst')
+
+    def replay_call(self, bk_obj_id, call_list):
+        """执行BkCmdbRecorder记录的某个模型的操作
+
+        argvs:
+            bk_obj_id = "bk_slb"
+            call_list = [("bk_slb", "add_inst", ({"bk_inst_name": "lb-xxxxxxxxxxxxx"},))]
+        """
+
+        for call_obj_id, func_name, argv in call_list:
+            if call_obj_id == bk_obj_id:
+                getattr(self, func_name)(*argv)
 
     def del_asst(self, bk_obj_id, ast_id, asst_info_dict):
         """删除实例关联关系
@@ -496,12 +942,47 @@ class BkCmdb():
             asst_info_dict = {"bk_obj_id":"bk_slb"} //用于显示
         """
 
+        asst_info_dict = dict(asst_info_dict, id=ast_id)
+        self.batch_del_asst(bk_obj_id, [asst_info_dict])
+
+    def batch_del_asst(self, bk_obj_id, asst_info_list):
+        """批量删除实例关联关系
+
+        argvs:
+            bk_obj_id = "bk_slb"
+            asst_info_list = [{"id": 25, "bk_obj_id":"bk_slb", "bk_asst_obj_id":"host"}]
+        """
+
         mycol = self.db['cc_InstAsst']
-        myquery = { "id": ast_id }
-        mycol.delete_one(myquery)
-        
-        #显示
-        logging.info("删除实例" + asst_info_dict["bk_obj_id"] + "到" + asst_info_dict["bk_asst_obj_id"] + "关联关系")
+        for i in range(0, len(asst_info_list), self.delete_batch_size):
+            batch_list = asst_info_list[i:i + self.delete_batch_size]
+            myquery = { "id": {"$in": [asst_info_dict["id"] for asst_info_dict in batch_list]} }
+            mycol.delete_many(myquery)
+
+            #显示
+            for asst_info_dict in batch_list:
+                logging.info("删除实例" + asst_info_dict["bk_obj_id"] + "到" + asst_info_dict["bk_asst_obj_id"] + "关联关系")
+
+    def make_key(self, info_dict, field_list):
+        """取出字典中指定字段，转换成可以放入集合的key
+
+        argvs:
+            info_dict = {"bk_obj_id":"bk_slb", "bk_inst_name":"生产-会员-内网", "_id": "xxx"}
+            field_list = ["bk_obj_id", "bk_inst_name"]
+
+        return:
+            key = frozenset({("bk_obj_id", "bk_slb"), ("bk_inst_name", "生产-会员-内网")})
+        """
+
+        item_list = []
+        for field in field_list:
+            value = info_dict.get(field)
+            try:
+                hash(value)
+            except TypeError:
+                value = repr(value)
+            item_list.append((field, value))
+        return frozenset(item_list)
 
     def clear_asst(self, bk_obj_id, real_asst_list):
         """清理cmdb中和源数据不符合的实例关联关系
@@ -512,30 +993,25 @@ class BkCmdb():
         """
 
         logging.info("开始清理" + bk_obj_id + "模型中和源数据不符合的实例关联关系")
+        self.flush_write()
 
-        #当前模块所有实例关联关系列表
+        #当前模块所有实例关联关系，比对时边遍历边取
         inq_dict = {"bk_obj_id" : bk_obj_id}
-        all_asst_list = self.get_asst(inq_dict)
+        all_asst_list = self.get_asst(inq_dict, stream=True)
 
         if real_asst_list:
-            #循环把需要的值加到私有的实例字典里
-            filter_real_asst_list = []
+            #按源数据的字段生成key，不在源数据集合里的就删除
+            field_list = list(real_asst_list[0].keys())
+            real_key_set = set(self.make_key(asst_info_dict, field_list) for asst_info_dict in real_asst_list)
+            del_asst_list = []
             for asst_info_dict in all_asst_list:
-                tmp_dict = {}
-                for field_type in real_asst_list[0].keys():
-                    tmp_dict[field_type] = asst_info_dict[field_type]
-                filter_real_asst_list.append(tmp_dict)
-
-            #从所有中循环，如果不在线上列表里就删除
-            for tmp_dict in filter_real_asst_list:
-                if tmp_dict not in real_asst_list:
-                    asst_info_list = self.get_asst(tmp_dict)
-                    self.del_asst(bk_obj_id, asst_info_list[0]["id"], tmp_dict)
+                if self.make_key(asst_info_dict, field_list) not in real_key_set:
+                    del_asst_list.append(asst_info_dict)
         else:
             logging.warn("源数据没有查询到任何值，将cmdb中数值都清理掉")
-            for tmp_dict in all_asst_list:
-                asst_info_list = self.get_asst(tmp_dict)
-                self.del_asst(bk_obj_id, asst_info_list[0]["id"], tmp_dict)
+            del_asst_list = list(all_asst_list)
+
+        self.batch_del_asst(bk_obj_id, del_asst_list)
 
     def clear_inst(self, bk_obj_id, real_inst_list):
         """清理cmdb中和源数据不符合的实例
@@ -546,46 +1022,71 @@ class BkCmdb():
         """
 
         logging.info("开始清理" + bk_obj_id + "模型中和源数据不符合的实例")
+        self.flush_write()
 
-        #当前模块下所有的实例信息列表
+        #当前模块下所有的实例信息，比对时边遍历边取
         inq_dict = {"bk_obj_id" : bk_obj_id}
-        all_inst_list = self.get_inst(inq_dict)
+        all_inst_list = self.get_inst(inq_dict, stream=True)
 
         #查看公共里是否有，没有说明源数据里啥也没有，那CMDB里都要删除
         if real_inst_list:
-            #循环把需要的值加到私有的实例字典里
-            filter_real_inst_list = []
+            #按源数据的字段生成key，找出不同元素
+            field_list = list(real_inst_list[0].keys())
+            real_key_set = set(self.make_key(inst_info_dict, field_list) for inst_info_dict in real_inst_list)
+            del_inst_list = []
             for inst_info_dict in all_inst_list:
-                tmp_dict = {}
-                for field_type in real_inst_list[0].keys():
-                    tmp_dict[field_type] = inst_info_dict[field_type]
-                filter_real_inst_list.append(tmp_dict)
-            #找出不同元素
-            for tmp_dict in filter_real_inst_list:
-                if tmp_dict not in real_inst_list:
-                    inst_info_list = self.get_inst(tmp_dict)
-                    #有时候bk_inst_name会莫名消失
-                    if "bk_inst_name" in tmp_dict.keys():
-                        self.del_inst(bk_obj_id, inst_info_list[0]["bk_inst_id"], tmp_dict["bk_inst_name"])
+                if self.make_key(inst_info_dict, field_list) not in real_key_set:
+                    del_inst_list.append(inst_info_dict)
         else:
             logging.info("源数据没有查询到任何值，将cmdb中数值都清理掉")
-            for tmp_dict in all_inst_list:
-                inst_info_list = self.get_inst(tmp_dict)
-                self.del_inst(bk_obj_id, inst_info_lost[0]["bk_inst_id"], tmp_dict["bk_inst_name"])
+            del_inst_list = list(all_inst_list)
+
+        #有时候bk_inst_name会莫名消失
+        del_inst_list = [inst_info_dict for inst_info_dict in del_inst_list if "bk_inst_name" in inst_info_dict.keys()]
+        self.batch_del_inst(bk_obj_id, del_inst_list)
 
     def get_job_id(self):
         """查询模型的id号
 
         return:
-            default_id_list = ["bk_server", "bk_slb"]
+            job_id_list = ["bk_server", "bk_slb"]
         """
 
         #系统自带的id排除掉
         job_id_list = []
-        mycol = self.db['cc_ObjDes']
         myquery = { "bk_classification_id": "bk_network" }
-        mydoc = mycol.find(myquery)
+        mydoc = self.find_doc('cc_ObjDes', myquery, {"_id": 0, "bk_obj_id": 1}, stream=True)
         for x in mydoc:
             job_id_list.append(x["bk_obj_id"])
 
-        return default_id_list
+        return job_id_list
+
+
+class BkCmdbRecorder():
+    """在子进程中代替BkCmdb，只记录要写入cmdb的操作，由主进程用BkCmdb.replay_call按顺序执行
+
+    多个账号和地域并发采集时，每个子进程一个记录器，主进程合并后只做一次比对和清理
+    """
+
+    def __init__(self):
+        self.public_inst_dict = {}
+        self.public_asst_dict = {}
+        self.bk_obj_id = None
+        self.call_list = []
+
+    def load_inst(self, bk_obj_id):
+        """开始采集一个模型，之后记录的操作都属于这个模型"""
+
+        self.bk_obj_id = bk_obj_id
+
+    def add_inst(self, inq_dict):
+        self.call_list.append((self.bk_obj_id, "add_inst", (dict(inq_dict),)))
+
+    def add_asst(self, bk_obj_id, bk_inst_name, bk_dest_keyword):
+        self.call_list.append((self.bk_obj_id, "add_asst", (bk_obj_id, bk_inst_name, bk_dest_keyword)))
+
+    def batch_add_asst(self, bk_obj_id, asst_list):
+        self.call_list.append((self.bk_obj_id, "batch_add_asst", (bk_obj_id, list(asst_list))))
+
+    def flush_write(self, col_name=None):
+        """子进程中没有要写入的内容"""
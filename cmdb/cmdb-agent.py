@@ -7,20 +7,74 @@ import json, os, sys,  commands
 import subprocess, time, platform
 from socket import *
 import socket, logging
+import struct, zlib, hashlib
+import argparse, random, threading
 
 #[master地址、端口]
 MASTER_IP = '10.0.0.1'
 MASTER_PORT = 9527
 
+#[上报协议：4字节魔数、1字节版本、1字节标记、4字节长度，之后是json内容，超过COMPRESS_SIZE字节时zlib压缩]
+PROTO_MAGIC = b'BKMS'
+PROTO_VERSION = 1
+FLAG_ZLIB = 1
+HEADER_FORMAT = '!4sBBI'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+COMPRESS_SIZE = 512
+
+#[上次master确认的上报信息保存的位置，每隔FULL_INTERVAL秒做一次全量上报]
+STATE_FILE = '/var/tmp/cmdb-agent.state'
+FULL_INTERVAL = 86400
+
+#[cpu型号、制造商、系统版本等固定信息的缓存，重启后失效]
+STATIC_FILE = '/var/tmp/cmdb-agent.static'
+
+#[单个采集项超过COLLECT_TIMEOUT秒没有返回就跳过]
+COLLECT_TIMEOUT = 10
+
 class SystemInfo():
     """获取系统信息"""
 
-    def __init__(self):
+    def __init__(self, static_file=STATIC_FILE):
         logging.basicConfig(level=logging.INFO,
             format='%(asctime)s %(funcName)s %(levelname)s %(message)s',
             datefmt='%Y-%m-%d %A %H:%M:%S')
         self.logging = logging
 
+        #固定信息的缓存，boot_id变化说明重启过，缓存作废
+        self.static_file = static_file
+        self.boot_id = self.read_file("/proc/sys/kernel/random/boot_id")
+        try:
+            with open(self.static_file) as f:
+                self.static_dict = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.static_dict = {}
+        if self.static_dict.get("boot_id") != self.boot_id:
+            self.static_dict = {"boot_id": self.boot_id}
+
+    def read_file(self, path):
+        """读取整个文件的内容，不存在时返回空字符串"""
+
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return ""
+
+    def get_static(self, key, func):
+        """固定信息先从缓存中取，没有再采集并写入缓存"""
+
+        if key not in self.static_dict:
+            self.static_dict[key] = func()
+            try:
+                tmp_file = self.static_file + ".tmp"
+                with open(tmp_file, 'w') as f:
+                    json.dump(self.static_dict, f)
+                os.rename(tmp_file, self.static_file)
+            except (IOError, OSError):
+                pass
+        return self.static_dict[key]
+
     def get_name(self):
         """获取当前机器主机名"""
 
@@ -36,16 +90,14 @@ class SystemInfo():
     def get_swap(self):
         """获取SWAP，单位M"""
 
+        #第一行是标题，只有标题说明没有swap
         swap_number = 0
-        if len(open("/proc/swaps", 'r').readlines()) != 1:
-            with open("/proc/swaps") as f:
-                for line in f:
-                    tmp = line.split()
-                    if len(tmp) == 5 and tmp[2].isdigit() is True:
-                        swap_number += int(tmp[2]) / 1024
-            return swap_number
-        else:
-            return 0
+        with open("/proc/swaps") as f:
+            for line in f:
+                tmp = line.split()
+                if len(tmp) == 5 and tmp[2].isdigit() is True:
+                    swap_number += int(tmp[2]) / 1024
+        return swap_number
   
     def get_ker(self):
         """获取内核与架构
@@ -72,19 +124,50 @@ class SystemInfo():
             cpu_info_dict= { "cpu_model": "Intel(R) Xeon(R) Platinum 8163 CPU @ 2.50GHz",'cpu_number':6}
         """
 
-        cpu_info_dict = {'cpu_model':'','cpu_number':0}
+        cpu_info_dict = {}
+        cpu_info_dict['cpu_model'] = self.get_static("cpu_model", self.get_cpu_model)
+        cpu_info_dict['cpu_number'] = self.get_cpu_number()
+        return cpu_info_dict
+
+    def get_cpu_number(self):
+        """获取核心数，优先读取/sys中在线的cpu范围，例如0-63,128-191"""
+
+        cpu_number = 0
+        for cpu_range in self.read_file("/sys/devices/system/cpu/online").split(","):
+            if "-" in cpu_range:
+                start, end = cpu_range.split("-")
+                cpu_number += int(end) - int(start) + 1
+            elif cpu_range.isdigit():
+                cpu_number += 1
+        if cpu_number:
+            return cpu_number
+
+        if hasattr(os, "sched_getaffinity"):
+            return len(os.sched_getaffinity(0))
+
         with open('/proc/cpuinfo') as f:
             for line in f:
-                tmp = line.split(":")
-                key = tmp[0].strip()
-                if key == "processor":
-                    cpu_info_dict['cpu_number'] += 1
-                if key == "model name":
-                    cpu_info_dict['cpu_model'] = tmp[1].strip()
-        return cpu_info_dict
+                if line.startswith("processor"):
+                    cpu_number += 1
+        return cpu_number
+
+    def get_cpu_model(self):
+        """获取cpu型号，读到第一个model name就停止"""
+
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+        return ''
+
+
+    def get_disk(self, key=None):
+        """获取主机磁盘总容量，单位G，按/sys/block中的整块磁盘计算，不包含分区"""
+
+        block_dict = self.get_block()
+        if block_dict:
+            return sum(block_dict.values())
 
-    def get_disk(self, key):
-        """获取主机磁盘总容量，单位G"""
         disk_number = 0
         with open("/proc/partitions") as f:
             for line in f:
@@ -94,6 +177,83 @@ class SystemInfo():
                         disk_number += int(tmp[2]) / 1024 / 1024
         return disk_number
 
+    def get_block(self):
+        """获取每块磁盘的大小，单位G，跳过loop、dm等没有实际设备的虚拟块设备
+
+        return:
+            block_dict = {"vda": 100.0, "nvme0n1": 1788.5}
+        """
+
+        block_dict = {}
+        try:
+            block_list = os.listdir("/sys/block")
+        except OSError:
+            return block_dict
+
+        for block in block_list:
+            if not os.path.exists("/sys/block/" + block + "/device"):
+                continue
+            sectors = self.read_file("/sys/block/" + block + "/size")
+            if sectors.isdigit():
+                block_dict[block] = round(int(sectors) * 512.0 / 1024 / 1024 / 1024, 2)
+        return block_dict
+
+    def get_load(self):
+        """获取1、5、15分钟的负载
+
+        return:
+            load_list = [0.15, 0.2, 0.3]
+        """
+
+        return [float(i) for i in self.read_file("/proc/loadavg").split()[:3]]
+
+    def get_filesystem(self):
+        """获取每个挂载点的容量和使用率，只统计有实际块设备的文件系统
+
+        return:
+            fs_dict = {"/": {"size": 40.0, "used": 12.5, "percent": 31.2}} //单位G
+        """
+
+        fs_dict = {}
+        with open("/proc/mounts") as f:
+            for line in f:
+                tmp = line.split()
+                if len(tmp) < 3 or not tmp[0].startswith("/dev/") or tmp[1] in fs_dict:
+                    continue
+                try:
+                    stat = os.statvfs(tmp[1])
+                except OSError:
+                    continue
+                size = stat.f_blocks * stat.f_frsize / 1024.0 / 1024 / 1024
+                used = (stat.f_blocks - stat.f_bfree) * stat.f_frsize / 1024.0 / 1024 / 1024
+                percent = round(used * 100 / size, 1) if size else 0
+                fs_dict[tmp[1]] = {"size": round(size, 2), "used": round(used, 2), "percent": percent}
+        return fs_dict
+
+    def get_nic(self):
+        """获取网卡和速率，单位Mb/s，读不到速率的为-1
+
+        return:
+            nic_dict = {"eth0": 10000}
+        """
+
+        nic_dict = {}
+        try:
+            nic_list = os.listdir("/sys/class/net")
+        except OSError:
+            return nic_dict
+
+        for nic in nic_list:
+            if nic == "lo":
+                continue
+            #网卡没有up时读取speed会报错
+            speed = self.read_file("/sys/class/net/" + nic + "/speed")
+            try:
+                nic_dict[nic] = int(speed)
+            except ValueError:
+                nic_dict[nic] = -1
+        return nic_dict
+
     def get_manufacturer(self):
         """返回制造商信息
 
@@ -101,17 +261,42 @@ class SystemInfo():
             manufacturer = "Lenovo ThinkSystem SR550 -[7X04CTO1WW]-/-[7X04CTO1WW]-"
         """
 
-        with open("/var/log/dmesg") as f:
-            for line in f:
-                if "DMI:" in line:
-                    tmp = line.split("DMI: ")
-                    tmp = tmp[1].split(",")
-                    return tmp[0]
+        return self.get_static("manufacturer", self.read_manufacturer)
+
+    def read_manufacturer(self):
+        """优先读取/sys/class/dmi/id，没有时再从dmesg中找"""
+
+        sys_vendor = self.read_file("/sys/class/dmi/id/sys_vendor")
+        product_name = self.read_file("/sys/class/dmi/id/product_name")
+        if sys_vendor or product_name:
+            return (sys_vendor + " " + product_name).strip()
+
+        try:
+            with open("/var/log/dmesg") as f:
+                for line in f:
+                    if "DMI:" in line:
+                        tmp = line.split("DMI: ")
+                        tmp = tmp[1].split(",")
+                        return tmp[0]
+        except (IOError, OSError):
+            pass
 
     def get_version(self):
         """获取版本，CentOS Linux 7.3.1611 Core"""
 
-        return ' '.join(platform.linux_distribution())
+        return self.get_static("os_name", self.read_version)
+
+    def read_version(self):
+        """新版本python没有linux_distribution，从/etc/os-release中读取"""
+
+        if hasattr(platform, "linux_distribution"):
+            return ' '.join(platform.linux_distribution())
+
+        for line in self.read_file("/etc/os-release").splitlines():
+            if line.startswith("PRETTY_NAME="):
+                return line.split("=", 1)[1].strip('"')
+        return ''
+
 
 def get_host_ip():
     try:
@@ -122,38 +307,321 @@ def get_host_ip():
         s.close()
     return ip
 
-#向master程序提交信息
-def post_port(data):
-    s=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-    s.connect((MASTER_IP,MASTER_PORT))
+def pack_frame(msg_dict):
+    """把消息打包成一帧"""
 
-    data['host_ip'] = get_host_ip()
-    data = str(data)
-    s.send(data.encode('utf-8'))
-    s.close()
+    payload = json.dumps(msg_dict).encode('utf-8')
+    flags = 0
+    if len(payload) > COMPRESS_SIZE:
+        payload = zlib.compress(payload)
+        flags |= FLAG_ZLIB
+    return struct.pack(HEADER_FORMAT, PROTO_MAGIC, PROTO_VERSION, flags, len(payload)) + payload
 
-if __name__ == '__main__':
-    host_info_dict = {}
+class MasterConn():
+    """和master之间的长连接，多次上报共用一个连接，每次上报等待master确认"""
+
+    def __init__(self, master_ip, master_port, timeout=30):
+        self.master_ip = master_ip
+        self.master_port = master_port
+        self.timeout = timeout
+        self.sock = None
+        self.seq = 0
 
+    def connect(self):
+        self.close()
+        self.sock = socket.create_connection((self.master_ip, self.master_port), self.timeout)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def recv_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise socket.error("master关闭了连接")
+            data += chunk
+        return data
+
+    def recv_frame(self):
+        """读取master回复的一帧"""
+
+        magic, version, flags, length = struct.unpack(HEADER_FORMAT, self.recv_exact(HEADER_SIZE))
+        if magic != PROTO_MAGIC:
+            raise socket.error("帧头错误")
+        payload = self.recv_exact(length)
+        if flags & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        return json.loads(payload.decode('utf-8'))
+
+    def send_report(self, msg_dict):
+        """上报一次主机信息，连接断开时重连后再发送一次
+
+        return:
+            ack_dict = {"seq": 1, "ack": True}
+        """
+
+        self.seq += 1
+        msg_dict["seq"] = self.seq
+        frame = pack_frame(msg_dict)
+        for retry in range(2):
+            try:
+                if self.sock is None:
+                    self.connect()
+                self.sock.sendall(frame)
+                ack_dict = self.recv_frame()
+                if ack_dict.get("seq") != self.seq:
+                    raise socket.error("确认的序号不一致")
+                return ack_dict
+            except (socket.error, socket.timeout, ValueError):
+                self.close()
+                if retry:
+                    raise
+
+class ReportState():
+    """本地保存上次master确认的上报信息，之后只上报变化的字段"""
+
+    def __init__(self, state_file=STATE_FILE):
+        self.state_file = state_file
+        try:
+            with open(self.state_file) as f:
+                self.state = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.state = {}
+
+    def make_msg(self, host_ip, data):
+        """生成上报的消息，到了全量上报的时间就上报全部字段，否则只上报变化的字段
+
+        return:
+            msg_dict = {"type": "delta", "host_ip": "1.1.1.1", "hash": "xxx", "base_hash": "xxx", "data": {"bk_mem": 16000}} //没有变化时为None
+        """
+
+        data_hash = hashlib.md5(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+        msg_dict = {"host_ip": host_ip, "hash": data_hash}
+
+        if time.time() - self.state.get("full_time", 0) >= FULL_INTERVAL or self.state.get("host_ip") != host_ip:
+            msg_dict["type"] = "full"
+            msg_dict["data"] = data
+        elif data_hash == self.state.get("hash"):
+            return None
+        else:
+            last_data = self.state.get("data", {})
+            msg_dict["type"] = "delta"
+            msg_dict["base_hash"] = self.state.get("hash")
+            msg_dict["data"] = dict((k, v) for k, v in data.items() if last_data.get(k) != v)
+        return msg_dict
+
+    def save(self, msg_dict, data, ack_dict):
+        """master确认后保存这次上报，master要求重新同步时清空，下次全量上报"""
+
+        if ack_dict.get("resync"):
+            self.state = {}
+        else:
+            full_time = self.state.get("full_time", 0)
+            if msg_dict["type"] == "full":
+                full_time = time.time()
+            self.state = {"host_ip": msg_dict["host_ip"], "hash": msg_dict["hash"], "data": data, "full_time": full_time}
+
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmp_file, self.state_file)
+
+class Collector():
+    """采集项注册表，每个采集项单独计时，超时的采集项跳过，不影响上报"""
+
+    def __init__(self, timeout=COLLECT_TIMEOUT):
+        self.timeout = timeout
+        self.collector_list = []
+        self.running_dict = {}
+
+    def register(self, name, func, static=False):
+        """注册采集项
+
+        argvs:
+            name = "mem" //采集项名称，用于计时
+            func: 采集函数，返回要上报的字段字典
+            static = False //是否是基本不变的信息
+        """
+
+        self.collector_list.append((name, func, static))
+
+    def run_func(self, name, func):
+        """在线程中执行采集函数，超时后不再等待
+
+        return:
+            result_dict = {"bk_mem": 16000} //超时或者出错时为None
+        """
+
+        #上次超时的还没结束，这次直接跳过
+        if name in self.running_dict and self.running_dict[name].is_alive():
+            return None
+
+        result_list = []
+        def run():
+            try:
+                result_list.append(func())
+            except Exception as e:
+                logging.warning("采集" + name + "出错:" + repr(e))
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(self.timeout)
+        if thread.is_alive():
+            self.running_dict[name] = thread
+            logging.warning("采集" + name + "超过" + str(self.timeout) + "秒，跳过")
+            return None
+        if result_list:
+            return result_list[0]
+
+    def collect(self, static=True):
+        """执行所有采集项
+
+        argvs:
+            static = True //是否执行基本不变的采集项
+
+        return:
+            (host_info_dict, collect_time_dict) = ({"bk_mem": 16000}, {"mem": 0.0001})
+        """
+
+        host_info_dict = {}
+        collect_time_dict = {}
+        for name, func, is_static in self.collector_list:
+            if is_static and not static:
+                continue
+            start_time = time.time()
+            result_dict = self.run_func(name, func)
+            collect_time_dict[name] = round(time.time() - start_time, 4)
+            if result_dict:
+                host_info_dict.update(result_dict)
+        return host_info_dict, collect_time_dict
+
+def get_collector(host_inst):
+    """注册所有的采集项，bk_开头的是cmdb主机字段，metric_开头的是监控数据，不参与增量比对"""
+
+    def get_kernel():
+        ker_dict = host_inst.get_ker()
+        return {"bk_ker": ker_dict["kernel"], "bk_os_bit": ker_dict['framework']}
+
+    def get_cpu():
+        cpu_info_dict = host_inst.get_cpu()
+        return {"bk_cpu_module": cpu_info_dict["cpu_model"], "bk_cpu": cpu_info_dict["cpu_number"]}
+
+    collector = Collector()
+    collector.register("name", lambda: {"bk_host_name": host_inst.get_name()}, True)
+    collector.register("kernel", get_kernel, True)
+    collector.register("manufacturer", lambda: {"bk_manufacturers": host_inst.get_manufacturer()}, True)
+    collector.register("os", lambda: {"bk_os_name": host_inst.get_version()}, True)
+    collector.register("mem", lambda: {"bk_mem": host_inst.get_mem()})
+    collector.register("swap", lambda: {"bk_swap": host_inst.get_swap()})
+    collector.register("cpu", get_cpu)
+    collector.register("disk", lambda: {"bk_disk": host_inst.get_disk(), "metric_block": host_inst.get_block()})
+    collector.register("load", lambda: {"metric_load": host_inst.get_load()})
+    collector.register("filesystem", lambda: {"metric_filesystem": host_inst.get_filesystem()})
+    collector.register("nic", lambda: {"metric_nic": host_inst.get_nic()})
+    return collector
+
+def split_metric(host_info_dict):
+    """把监控数据从主机字段中拆出来
+
+    return:
+        (data, metric_dict) = ({"bk_mem": 16000}, {"metric_load": [0.1, 0.2, 0.3]})
+    """
+
+    data = {}
+    metric_dict = {}
+    for k, v in host_info_dict.items():
+        if k.startswith("metric_"):
+            metric_dict[k] = v
+        else:
+            data[k] = v
+    return data, metric_dict
+
+#向master程序提交信息，extra_dict是监控数据和采集耗时，不参与增量比对，每次都会上报
+def post_port(data, host_ip=None, conn=None, report_state=None, extra_dict=None):
+    if report_state is None:
+        report_state = ReportState()
+    if host_ip is None:
+        host_ip = get_host_ip()
+    msg_dict = report_state.make_msg(host_ip, data)
+    if msg_dict is None:
+        if not extra_dict:
+            logging.info("主机信息没有变化，跳过上报")
+            return
+        msg_dict = {"type": "delta", "host_ip": host_ip, "hash": report_state.state["hash"], "base_hash": report_state.state["hash"], "data": {}}
+    if extra_dict:
+        msg_dict.update(extra_dict)
+
+    #没有传入长连接时，上报完就关闭
+    if conn is None:
+        tmp_conn = MasterConn(MASTER_IP, MASTER_PORT)
+        try:
+            ack_dict = tmp_conn.send_report(msg_dict)
+        finally:
+            tmp_conn.close()
+    else:
+        ack_dict = conn.send_report(msg_dict)
+    report_state.save(msg_dict, data, ack_dict)
+
+#常驻运行，每隔interval秒加减jitter秒的随机时间上报一次，static_interval秒刷新一次基本信息
+def run_daemon(interval, jitter, static_interval):
     host_inst = SystemInfo()
-    host_info_dict["bk_host_name"] = host_inst.get_name()
-    host_info_dict["bk_mem"] = host_inst.get_mem()
-    host_info_dict["bk_swap"] = host_inst.get_swap()
+    collector = get_collector(host_inst)
+    report_state = ReportState()
+    conn = MasterConn(MASTER_IP, MASTER_PORT)
+    static_dict = {}
+    static_time = 0
+    host_ip = None
 
-    ker_dict = host_inst.get_ker()
-    host_info_dict["bk_ker"] = ker_dict["kernel"]
-    host_info_dict["bk_os_bit"] = ker_dict['framework']
+    #启动时随机等待，避免所有机器同时上报
+    time.sleep(random.uniform(0, jitter))
+    while True:
+        start_time = time.time()
+        try:
+            static = start_time - static_time >= static_interval
+            if static:
+                host_ip = get_host_ip()
+                static_time = start_time
 
-    cpu_info_dict =  host_inst.get_cpu()
-    host_info_dict["bk_cpu_module"] = cpu_info_dict["cpu_model"]
-    host_info_dict["bk_cpu"] = cpu_info_dict["cpu_number"]
-    try:
-        host_info_dict["bk_disk"] = host_inst.get_disk("Disk")
-    except:
-        host_info_dict["bk_disk"] = host_inst.get_disk("磁盘")
-
-    host_info_dict["bk_manufacturers"] = host_inst.get_manufacturer()
-    host_info_dict["bk_os_name"] = host_inst.get_version()
-   
-    post_port(host_info_dict)
-    print("更新信息完成")
+            host_info_dict, collect_time_dict = collector.collect(static)
+            data, metric_dict = split_metric(host_info_dict)
+
+            #基本信息沿用上次采集的
+            if static:
+                static_dict = {}
+                for name in ["bk_host_name", "bk_ker", "bk_os_bit", "bk_manufacturers", "bk_os_name"]:
+                    if name in data:
+                        static_dict[name] = data[name]
+            for k, v in static_dict.items():
+                data.setdefault(k, v)
+
+            extra_dict = {"metric": metric_dict, "collect_time": collect_time_dict}
+            post_port(data, host_ip, conn, report_state, extra_dict)
+        except Exception as e:
+            #下次重新获取ip和基本信息
+            logging.warning("上报失败:" + repr(e))
+            static_time = 0
+
+        sleep_time = interval + random.uniform(-jitter, jitter) - (time.time() - start_time)
+        time.sleep(max(1, sleep_time))
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="采集主机信息上报到master")
+    arg_parser.add_argument("--daemon", action="store_true", help="常驻运行，定时上报")
+    arg_parser.add_argument("--interval", type=int, default=3600, help="常驻运行时的上报间隔，单位秒")
+    arg_parser.add_argument("--jitter", type=int, default=300, help="上报间隔的随机浮动，单位秒")
+    arg_parser.add_argument("--static-interval", type=int, default=86400, help="刷新基本信息的间隔，单位秒")
+    args = arg_parser.parse_args()
+
+    if args.daemon:
+        run_daemon(args.interval, args.jitter, args.static_interval)
+    else:
+        host_inst = SystemInfo()
+        host_info_dict, collect_time_dict = get_collector(host_inst).collect()
+        data, metric_dict = split_metric(host_info_dict)
+
+        post_port(data, extra_dict={"metric": metric_dict, "collect_time": collect_time_dict})
+        print("更新信息完成")